@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import sys
+
+import checkpoints
+import workerProcess
+
+PROBE_SIZES = [1, 2, 4, 8, 16, 32, 64]
+PROBE_STEPS = 5
+PROBE_WARMUP = 2
+MEMORY_FRACTION = 0.8  # default budget: this share of the physical memory
+RESULT_FILE = "./trained_models/batch_size.json"
+
+def physical_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.0 * 1024.0)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Child process of probe(): one short timed training run at batch_size on synthetic data.
+# CNTK is only imported here, trainCycleGAN imports this module for --batch-size auto.
+def probe_worker(resolution, batch_size, fused, num_steps, num_warmup, use_cpu):
+    import benchCycleGAN
+    import trainCycleGAN
+
+    trainCycleGAN.select_device(not use_cpu)
+    result = benchCycleGAN.bench_training_step(resolution, batch_size, 1, num_steps, num_warmup, fused)
+    result['batch_size'] = batch_size
+    workerProcess.print_result(result)
+
+# Runs probe_worker in its own process, so an out-of-memory failure only ends the probe and every
+# probe's peak RSS is its own. A failed probe is reported with 'failed' set.
+def probe(resolution, batch_size, fused=False, num_steps=PROBE_STEPS, num_warmup=PROBE_WARMUP, use_cpu=False):
+    command = [sys.executable, __file__, '--probe-worker', str(batch_size), '--resolution', str(resolution),
+               '--steps', str(num_steps), '--warmup', str(num_warmup)] + \
+              (['--fused'] if fused else []) + (['--cpu'] if use_cpu else [])
+    try:
+        return workerProcess.run_worker(command)
+    except workerProcess.WorkerError as e:
+        return {'batch_size': batch_size, 'failed': True, 'error': str(e)}
+
+# Probes increasing batch sizes until one fails or exceeds memory_budget_mb (default: MEMORY_FRACTION of the
+# physical memory) and recommends the fastest size in samples/sec that stayed within the budget.
+# The budget applies to the peak RSS of the process; on GPU, device memory is bounded by the sizes that ran.
+def find_batch_size(resolution, memory_budget_mb=None, sizes=PROBE_SIZES, fused=False, num_steps=PROBE_STEPS,
+                    num_warmup=PROBE_WARMUP, use_cpu=False):
+    if memory_budget_mb is None:
+        physical = physical_memory_mb()
+        memory_budget_mb = physical * MEMORY_FRACTION if physical else None
+
+    probes = []
+    for batch_size in sizes:
+        result = probe(resolution, batch_size, fused, num_steps, num_warmup, use_cpu)
+        result['within_budget'] = not result.get('failed') and (
+            memory_budget_mb is None or result['peak_rss_mb'] is None or result['peak_rss_mb'] <= memory_budget_mb)
+        probes.append(result)
+        print(format_probe(result))
+        if not result['within_budget']:
+            break
+
+    candidates = [result for result in probes if result['within_budget']]
+    recommended = max(candidates, key=lambda result: result['samples_per_sec'])['batch_size'] if candidates else None
+    return {'resolution': resolution, 'device': 'cpu' if use_cpu else 'gpu', 'fused': fused,
+            'memory_budget_mb': memory_budget_mb, 'recommended': recommended, 'probes': probes}
+
+def format_probe(result):
+    if result.get('failed'):
+        return "batch %3d: failed (%s)" % (result['batch_size'], result['error'])
+    peak = result['peak_rss_mb']
+    return "batch %3d: %.2f samples/sec, peak memory %s%s" % (
+        result['batch_size'], result['samples_per_sec'], "%.0f MB" % peak if peak is not None else "n/a",
+        "" if result['within_budget'] else ", over budget")
+
+def save_result(result, path=RESULT_FILE):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    checkpoints.write_json_atomic(path, result)
+
+# A previous search for the same setup, so `--batch-size auto` does not probe again on every start
+def load_result(resolution, use_cpu, fused, memory_budget_mb=None, path=RESULT_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        result = json.load(f)
+    same_setup = (result['resolution'] == resolution and result['device'] == ('cpu' if use_cpu else 'gpu')
+                  and result['fused'] == fused
+                  and (memory_budget_mb is None or result['memory_budget_mb'] == memory_budget_mb))
+    return result if same_setup else None
+
+# Recommended batch size for training, from RESULT_FILE if it matches the setup, otherwise from a new search
+def auto_batch_size(resolution, use_cpu=False, fused=False, memory_budget_mb=None, path=RESULT_FILE):
+    result = load_result(resolution, use_cpu, fused, memory_budget_mb, path)
+    if result is None:
+        print("Searching the largest batch size for %d px images" % resolution)
+        result = find_batch_size(resolution, memory_budget_mb, fused=fused, use_cpu=use_cpu)
+        save_result(result, path)
+    if result['recommended'] is None:
+        raise RuntimeError("No batch size in %s fits into %s MB" % (PROBE_SIZES, result['memory_budget_mb']))
+    print("Using batch size %d (search results in %s)" % (result['recommended'], path))
+    return result['recommended']
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the fastest CycleGAN batch size within a memory budget")
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--budget-mb', type=float, default=None,
+                        help="peak memory budget, default %d%% of the physical memory" % (MEMORY_FRACTION * 100))
+    parser.add_argument('--sizes', type=int, nargs='+', default=PROBE_SIZES)
+    parser.add_argument('--fused', action='store_true')
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--steps', type=int, default=PROBE_STEPS)
+    parser.add_argument('--warmup', type=int, default=PROBE_WARMUP)
+    parser.add_argument('--output', default=RESULT_FILE)
+    parser.add_argument('--probe-worker', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe_worker is not None:
+        probe_worker(args.resolution, args.probe_worker, args.fused, args.steps, args.warmup, args.cpu)
+        return
+    result = find_batch_size(args.resolution, args.budget_mb, args.sizes, args.fused, args.steps, args.warmup,
+                             args.cpu)
+    save_result(result, args.output)
+    print("Recommended batch size: %s" % result['recommended'])
+
+if __name__ == '__main__':
+    main()
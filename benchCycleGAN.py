@@ -0,0 +1,268 @@
+import argparse
+import atexit
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import gradientAccumulation
+import phaseTimer
+import trainCycleGAN
+import utils
+import workerProcess
+
+RESOLUTIONS = [64, 128, 256]
+SCALING_WORKERS = [1, 2, 4]
+# (micro-batch size, accumulation steps) compared at the same effective batch of 16
+ACCUMULATION_CONFIGS = [(16, 1), (8, 2), (4, 4), (2, 8)]
+
+# Synthetic uint8 images (stored as float32, the way the readers feed them)
+def synthetic_images(batch_size, image_shape, rng):
+    return rng.integers(0, 256, size=(batch_size,) + tuple(image_shape), dtype=np.uint8).astype(np.float32)
+
+def image_shape(resolution):
+    return (trainCycleGAN.NUM_CHANNELS, resolution, resolution)
+
+# TensorBoard logs of benchmark graphs go to a temporary directory removed at exit, never to the
+# tblogs_* folders of a training run in the working directory
+def temp_log_dir():
+    log_dir = tempfile.mkdtemp(prefix="benchCycleGAN_tblogs_")
+    atexit.register(shutil.rmtree, log_dir, True)
+    return log_dir
+
+def build(image_shape, fused, distributed=False):
+    graph = trainCycleGAN.build_graph(image_shape=image_shape, generator=trainCycleGAN.generator,
+                                      discriminator=trainCycleGAN.discriminator, fused=fused,
+                                      distributed=distributed, log_dir=temp_log_dir())
+    real_X, real_Y = graph[0], graph[1]
+    G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer = graph[10:14]
+    update_order = trainCycleGAN.unique_trainers([G_G_trainer, D_Y_trainer, G_F_trainer, D_X_trainer])
+    return real_X, real_Y, update_order
+
+# Wall clock seconds of each training step: every trainer of update_order runs once on the same batch
+def time_training_steps(update_order, batch_inputs, num_steps, num_warmup):
+    def step():
+        for trainer in update_order:
+            trainer.train_minibatch(batch_inputs)
+    return phaseTimer.time_calls(step, num_steps, num_warmup)
+
+def summarize(times):
+    return {'mean_s': float(np.mean(times)), 'median_s': float(np.median(times)),
+            'min_s': float(np.min(times)), 'steps': len(times)}
+
+# Per-step wall clock of the four-trainer loop against the fused generator/discriminator step
+def bench_fused(resolution, batch_size, num_steps, num_warmup, seed=0):
+    rng = np.random.default_rng(seed)
+    X = synthetic_images(batch_size, image_shape(resolution), rng)
+    Y = synthetic_images(batch_size, image_shape(resolution), rng)
+    results = {}
+    for fused in (False, True):
+        real_X, real_Y, update_order = build(image_shape(resolution), fused)
+        times = time_training_steps(update_order, {real_X: X, real_Y: Y}, num_steps, num_warmup)
+        results['fused' if fused else 'four_trainers'] = summarize(times)
+    results['speedup'] = results['four_trainers']['median_s'] / results['fused']['median_s']
+    return results
+
+# Times the pieces of a training iteration separately: graph construction, each of the four
+# train_minibatch calls, generator evaluation, parameter logging and sample image writing
+def bench_components(resolution, batch_size, num_steps, num_warmup, seed=0):
+    rng = np.random.default_rng(seed)
+    X = synthetic_images(batch_size, image_shape(resolution), rng)
+    Y = synthetic_images(batch_size, image_shape(resolution), rng)
+
+    log_dir = temp_log_dir()
+    start = time.perf_counter()
+    graph = trainCycleGAN.build_graph(image_shape=image_shape(resolution), generator=trainCycleGAN.generator,
+                                      discriminator=trainCycleGAN.discriminator, log_dir=log_dir)
+    results = {'build_graph': summarize([time.perf_counter() - start])}
+
+    real_X, real_Y, genF, genG = graph[0:4]
+    G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer = graph[10:14]
+    tb_G_G = graph[14]
+    batch_inputs = {real_X: X, real_Y: Y}
+
+    for name, trainer in (("G_G", G_G_trainer), ("D_Y", D_Y_trainer), ("G_F", G_F_trainer), ("D_X", D_X_trainer)):
+        results['train_minibatch_' + name] = summarize(
+            phaseTimer.time_calls(lambda: trainer.train_minibatch(batch_inputs), num_steps, num_warmup))
+    results['genG_eval'] = summarize(phaseTimer.time_calls(lambda: genG.eval({real_X: X}), num_steps, num_warmup))
+    results['genF_eval'] = summarize(phaseTimer.time_calls(lambda: genF.eval({real_Y: Y}), num_steps, num_warmup))
+    results['logTensorBoard'] = summarize(
+        phaseTimer.time_calls(lambda: utils.logTensorBoard(G_G_trainer, tb_G_G, "bench", 0),
+                              num_steps, num_warmup))
+
+    images = genG.eval({real_X: X})
+    with tempfile.TemporaryDirectory() as images_dir:
+        results['save_generated_images'] = summarize(
+            phaseTimer.time_calls(lambda: utils.save_generated_images(images, "G", 0, images_dir),
+                                  num_steps, num_warmup))
+    return results
+
+# Runs inside every mpiexec worker: data parallel steps on synthetic data, each worker feeding
+# batch_size samples per step; rank 0 prints the result for run_scaling
+def bench_distributed_step(resolution, batch_size, num_steps, num_warmup, seed=0):
+    import cntk as C
+    rng = np.random.default_rng(seed + C.Communicator.rank())
+    X = synthetic_images(batch_size, image_shape(resolution), rng)
+    Y = synthetic_images(batch_size, image_shape(resolution), rng)
+    real_X, real_Y, update_order = build(image_shape(resolution), fused=False, distributed=True)
+    times = time_training_steps(update_order, {real_X: X, real_Y: Y}, num_steps, num_warmup)
+    num_workers = C.Communicator.num_workers()
+    if C.Communicator.rank() == 0:
+        result = summarize(times)
+        result['workers'] = num_workers
+        result['samples_per_sec'] = num_workers * batch_size / result['median_s']
+        workerProcess.print_result(result)
+    C.train.distributed.Communicator.finalize()
+
+# Throughput of 1, 2, 4, ... local workers launched with mpiexec
+def run_scaling(worker_counts, resolution, batch_size, num_steps, num_warmup, use_cpu):
+    results = {}
+    for num_workers in worker_counts:
+        command = ['mpiexec', '-n', str(num_workers), sys.executable, __file__, '--distributed-worker',
+                   '--resolutions', str(resolution), '--batch-size', str(batch_size),
+                   '--steps', str(num_steps), '--warmup', str(num_warmup)] + (['--cpu'] if use_cpu else [])
+        results[str(num_workers)] = workerProcess.run_worker(command)
+    base = results[str(worker_counts[0])]['samples_per_sec']
+    for result in results.values():
+        result['speedup'] = result['samples_per_sec'] / base
+        result['efficiency'] = result['speedup'] * worker_counts[0] / result['workers']
+    return results
+
+# Timed training steps of one configuration, with throughput and peak RSS. Meant to run in a process of its
+# own (the accumulation worker here, batchSizeFinder's probes), so that peak RSS belongs to it alone.
+def bench_training_step(resolution, micro_batch_size, accumulation_steps, num_steps, num_warmup, fused=False,
+                        seed=0):
+    rng = np.random.default_rng(seed)
+    batch_size = micro_batch_size * accumulation_steps
+    X = synthetic_images(batch_size, image_shape(resolution), rng)
+    Y = synthetic_images(batch_size, image_shape(resolution), rng)
+    real_X, real_Y, update_order = build(image_shape(resolution), fused)
+    if accumulation_steps > 1:
+        update_order = gradientAccumulation.wrap_trainers(update_order, micro_batch_size)
+    result = summarize(time_training_steps(update_order, {real_X: X, real_Y: Y}, num_steps, num_warmup))
+    result.update({'micro_batch_size': micro_batch_size, 'accumulation_steps': accumulation_steps,
+                   'effective_batch_size': batch_size, 'samples_per_sec': batch_size / result['median_s'],
+                   'peak_rss_mb': utils.peak_rss_mb()})
+    return result
+
+def run_accumulation(configs, resolution, num_steps, num_warmup, use_cpu):
+    results = []
+    for micro_batch_size, accumulation_steps in configs:
+        command = [sys.executable, __file__, '--accumulation-worker', str(micro_batch_size), str(accumulation_steps),
+                   '--resolutions', str(resolution), '--steps', str(num_steps), '--warmup', str(num_warmup)] + \
+                  (['--cpu'] if use_cpu else [])
+        results.append(workerProcess.run_worker(command))
+    return results
+
+def accumulation_table(resolution, results):
+    lines = ["| resolution | micro-batch | accumulation steps | effective batch | samples/sec | peak RSS (MB) |",
+             "|---|---|---|---|---|---|"]
+    for r in results:
+        peak = "%.0f" % r['peak_rss_mb'] if r['peak_rss_mb'] is not None else "n/a"
+        lines.append("| %d | %d | %d | %d | %.2f | %s |" % (resolution, r['micro_batch_size'], r['accumulation_steps'],
+                                                          r['effective_batch_size'], r['samples_per_sec'], peak))
+    return "\n".join(lines)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# (resolution, benchmark, baseline s, current s) of every timing that got slower than tolerance allows
+def find_regressions(baseline, current, tolerance):
+    regressions = []
+    for resolution, suites in current['resolutions'].items():
+        base_components = baseline['resolutions'].get(resolution, {}).get('components', {})
+        for name, timing in suites.get('components', {}).items():
+            if name in base_components and timing['median_s'] > base_components[name]['median_s'] * (1 + tolerance):
+                regressions.append((resolution, name, base_components[name]['median_s'], timing['median_s']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="CycleGAN training step benchmarks on synthetic data")
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--suite', choices=['components', 'fused', 'scaling', 'accumulation', 'all'], default='all',
+                        help="'all' runs components and fused; 'scaling' launches mpiexec for every --workers count; "
+                             "'accumulation' compares micro-batch sizes at the same effective batch")
+    parser.add_argument('--workers', type=int, nargs='+', default=SCALING_WORKERS)
+    parser.add_argument('--distributed-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--accumulation-worker', type=int, nargs=2, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=RESOLUTIONS)
+    parser.add_argument('--batch-size', type=int, default=trainCycleGAN.MINIBATCH_SIZE)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default=None, help="write the results as JSON to this file")
+    parser.add_argument('--compare', default=None, help="JSON results of a baseline revision")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative slowdown against --compare")
+    args = parser.parse_args()
+
+    if args.distributed_worker:
+        import cntk as C
+        trainCycleGAN.select_device(not args.cpu, C.Communicator.rank())
+        bench_distributed_step(args.resolutions[0], args.batch_size, args.steps, args.warmup)
+        return
+    if args.accumulation_worker:
+        trainCycleGAN.select_device(not args.cpu)
+        workerProcess.print_result(bench_training_step(args.resolutions[0], args.accumulation_worker[0],
+                                                       args.accumulation_worker[1], args.steps, args.warmup))
+        return
+    if args.suite == 'accumulation':
+        results = {'revision': git_revision(), 'platform': platform.platform(), 'accumulation': {}}
+        for resolution in args.resolutions:
+            accumulation = results['accumulation'][str(resolution)] = run_accumulation(
+                ACCUMULATION_CONFIGS, resolution, args.steps, args.warmup, args.cpu)
+            print(accumulation_table(resolution, accumulation))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+    if args.suite == 'scaling':
+        results = {'revision': git_revision(), 'platform': platform.platform(), 'scaling': {}}
+        for resolution in args.resolutions:
+            scaling = results['scaling'][str(resolution)] = run_scaling(
+                args.workers, resolution, args.batch_size, args.steps, args.warmup, args.cpu)
+            for num_workers in args.workers:
+                result = scaling[str(num_workers)]
+                print("%4d px  %d workers: %.2f samples/sec, speedup x%.2f, efficiency %.0f%%" %
+                      (resolution, num_workers, result['samples_per_sec'], result['speedup'],
+                       result['efficiency'] * 100))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    trainCycleGAN.select_device(not args.cpu)
+    results = {'revision': git_revision(), 'platform': platform.platform(), 'device': 'cpu' if args.cpu else 'gpu',
+               'batch_size': args.batch_size, 'steps': args.steps, 'resolutions': {}}
+    for resolution in args.resolutions:
+        res_results = results['resolutions'][str(resolution)] = {}
+        if args.suite in ('components', 'all'):
+            res_results['components'] = bench_components(resolution, args.batch_size, args.steps, args.warmup)
+            for name, timing in res_results['components'].items():
+                print("%4d px  %-28s %.4f s" % (resolution, name, timing['median_s']))
+        if args.suite in ('fused', 'all'):
+            fused_step = res_results['fused_step'] = bench_fused(resolution, args.batch_size, args.steps, args.warmup)
+            print("%4d px  four trainers: %.4f s/step, fused: %.4f s/step, speedup x%.2f" %
+                  (resolution, fused_step['four_trainers']['median_s'], fused_step['fused']['median_s'],
+                   fused_step['speedup']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = find_regressions(json.load(f), results, args.tolerance)
+        for resolution, name, baseline_s, current_s in regressions:
+            print("REGRESSION %s px %s: %.4f s -> %.4f s" % (resolution, name, baseline_s, current_s))
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import imageCache
+import packedDataset
+
+MINIBATCH_SIZE = 128
+SYNTHETIC_SAMPLES = 10000
+FEATURE_DIM = 28 * 28
+LABEL_DIM = 10
+
+# MNIST-like CTF text: one-hot labels and byte valued features, as CNTK 103 A writes them
+def write_synthetic_ctf(path, num_samples, feature_dim=FEATURE_DIM, label_dim=LABEL_DIM, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for _ in range(num_samples):
+            labels = np.eye(label_dim, dtype=np.uint8)[rng.integers(label_dim)]
+            features = rng.integers(0, 256, size=feature_dim)
+            f.write("|labels {0} |features {1}\n".format(" ".join(map(str, labels)), " ".join(map(str, features))))
+
+# samples/sec of reading num_samples samples as float32 minibatches with next_batch
+def samples_per_sec(next_batch, num_samples, minibatch_size):
+    start = time.perf_counter()
+    read = 0
+    while read < num_samples:
+        read += len(next_batch(minibatch_size))
+    return read / (time.perf_counter() - start)
+
+def bench_text_parse(ctf_file, num_samples, minibatch_size):
+    def batches():
+        while True:
+            for streams in packedDataset.read_ctf(ctf_file):
+                yield streams[packedDataset.FEATURES_STREAM]
+    rows = batches()
+    return samples_per_sec(lambda n: np.stack([next(rows) for _ in range(n)]), num_samples, minibatch_size)
+
+# CNTK's own CTF reader, None when CNTK is not installed
+def bench_ctf_deserializer(ctf_file, num_samples, minibatch_size, feature_dim, label_dim):
+    try:
+        from cntk.io import MinibatchSource, CTFDeserializer, StreamDef, StreamDefs, INFINITELY_REPEAT
+    except ImportError:
+        return None
+    source = MinibatchSource(CTFDeserializer(ctf_file, StreamDefs(
+        labels=StreamDef(field='labels', shape=label_dim, is_sparse=False),
+        features=StreamDef(field='features', shape=feature_dim, is_sparse=False))),
+        randomize=True, max_sweeps=INFINITELY_REPEAT)
+    return samples_per_sec(lambda n: source.next_minibatch(n)[source.streams.features].asarray(),
+                           num_samples, minibatch_size)
+
+def bench_packed(cache_prefix, num_samples, minibatch_size):
+    source = imageCache.MemmapMinibatchSource(cache_prefix)
+    return samples_per_sec(source.next_minibatch, num_samples, minibatch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Read throughput of CTF text against the packed .npy format")
+    parser.add_argument('ctf_file', nargs='?', default=None,
+                        help="e.g. data/MNIST/Train-28x28_cntk_text.txt; a synthetic MNIST-like file if not set")
+    parser.add_argument('--synthetic-samples', type=int, default=SYNTHETIC_SAMPLES)
+    parser.add_argument('--samples', type=int, default=None, help="samples read per format, default one sweep")
+    parser.add_argument('--minibatch-size', type=int, default=MINIBATCH_SIZE)
+    parser.add_argument('--output', default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ctf_file = args.ctf_file
+        if ctf_file is None:
+            ctf_file = os.path.join(temp_dir, "synthetic_cntk_text.txt")
+            write_synthetic_ctf(ctf_file, args.synthetic_samples)
+        cache_prefix = os.path.join(temp_dir, "packed")
+        start = time.perf_counter()
+        packedDataset.pack_ctf(ctf_file, cache_prefix)
+        pack_seconds = time.perf_counter() - start
+
+        packed = np.load(cache_prefix + imageCache.CACHE_SUFFIX, mmap_mode='r')
+        labels = packedDataset.load_labels(cache_prefix)
+        num_samples = args.samples or packed.shape[0]
+        results = {'samples': num_samples, 'minibatch_size': args.minibatch_size, 'pack_seconds': pack_seconds,
+                   'ctf_mb': os.path.getsize(ctf_file) / 1e6,
+                   'packed_mb': (os.path.getsize(cache_prefix + imageCache.CACHE_SUFFIX) +
+                                 os.path.getsize(cache_prefix + packedDataset.LABELS_SUFFIX)) / 1e6,
+                   'samples_per_sec': {
+                       'ctf_text_parse': bench_text_parse(ctf_file, num_samples, args.minibatch_size),
+                       'ctf_deserializer': bench_ctf_deserializer(ctf_file, num_samples, args.minibatch_size,
+                                                                  packed.shape[1], labels.shape[1]),
+                       'packed_memmap': bench_packed(cache_prefix, num_samples, args.minibatch_size)}}
+        del packed, labels
+
+    print("CTF text %.1f MB, packed %.1f MB (x%.1f smaller), packed in %.1f s" %
+          (results['ctf_mb'], results['packed_mb'], results['ctf_mb'] / results['packed_mb'], results['pack_seconds']))
+    for name, rate in results['samples_per_sec'].items():
+        print("%-18s %s" % (name, "%.0f samples/sec" % rate if rate is not None else "n/a (CNTK not installed)"))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import json
+import os
+import queue
+import shutil
+import threading
+
+MANIFEST_FILE_NAME = "checkpoints.json"
+
+def write_json_atomic(file_name, obj):
+    temp_name = file_name + ".tmp"
+    with open(temp_name, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(temp_name, file_name)
+
+# Saves model checkpoints on a background thread.
+# save() only snapshots the models (a parameter copy on the device) and returns; the worker serializes
+# each model to a temporary file and renames it into place, so a crash never leaves a truncated .dnn.
+# checkpoints.json lists the complete checkpoints; all but the keep_last most recent and the keep_best
+# lowest metric ones are deleted.
+class CheckpointWriter(object):
+    def __init__(self, model_dir, keep_last=5, keep_best=1, max_pending=2):
+        self.model_dir = model_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        self.manifest_file = os.path.join(model_dir, MANIFEST_FILE_NAME)
+        self.checkpoints = []
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.checkpoints = json.load(f)['checkpoints']
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, objects, object_labels, ckp_label, metric=None):
+        self._raise_pending_error()
+        snapshots = [obj.clone('clone') for obj in objects]
+        self._queue.put((snapshots, object_labels, ckp_label, metric))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_pending_error()
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, snapshots, object_labels, ckp_label, metric):
+        files = {}
+        for snapshot, label in zip(snapshots, object_labels):
+            checkpoint_file = os.path.join(self.model_dir, "{}_{}.dnn".format(label, ckp_label))
+            snapshot.save(checkpoint_file + ".tmp")
+            os.replace(checkpoint_file + ".tmp", checkpoint_file)
+            files[label] = checkpoint_file
+
+        self.checkpoints = [c for c in self.checkpoints if c['label'] != str(ckp_label)]
+        self.checkpoints.append({'label': str(ckp_label), 'files': files, 'metric': metric})
+
+        keep = set(c['label'] for c in self.checkpoints[-self.keep_last:]) if self.keep_last > 0 else set()
+        scored = [c for c in self.checkpoints if c['metric'] is not None]
+        keep.update(c['label'] for c in sorted(scored, key=lambda c: c['metric'])[:self.keep_best])
+        dropped = [c for c in self.checkpoints if c['label'] not in keep]
+        self.checkpoints = [c for c in self.checkpoints if c['label'] in keep]
+
+        # the manifest never lists a checkpoint whose files are already gone
+        write_json_atomic(self.manifest_file, {'checkpoints': self.checkpoints})
+        for checkpoint in dropped:
+            for checkpoint_file in checkpoint['files'].values():
+                if os.path.exists(checkpoint_file):
+                    os.remove(checkpoint_file)
+
+TRAINING_STATE_FILE_NAME = "train_state.json"
+
+# Full training state, written every few steps so that a preempted run can continue where it stopped:
+# the model and learner state of every trainer (Trainer.save_checkpoint), the reader positions and the
+# step counter. The state goes to <state_root>/step_<N>.tmp which is renamed once complete;
+# only the keep_last most recent states are kept.
+# With distributed learners every worker has to call Trainer.save_checkpoint, but only the chief writes.
+def save_training_state(state_root, train_step, trainers, reader_states, keep_last=2, extra=None, is_chief=True):
+    state_dir = os.path.join(state_root, "step_%d" % train_step)
+    temp_dir = state_dir + ".tmp"
+    if is_chief and not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+
+    files = {}
+    for name, trainer in trainers.items():
+        files[name] = "%s.ckp" % name
+        trainer.save_checkpoint(os.path.join(temp_dir, files[name]),
+                                {'train_step': train_step, 'readers': reader_states})
+    if not is_chief:
+        return state_dir
+    state = {'train_step': train_step, 'trainers': files}
+    state.update(extra or {})
+    write_json_atomic(os.path.join(temp_dir, TRAINING_STATE_FILE_NAME), state)
+
+    if os.path.exists(state_dir):
+        shutil.rmtree(state_dir)
+    os.replace(temp_dir, state_dir)
+
+    for old_dir in list_training_states(state_root)[:-keep_last]:
+        shutil.rmtree(old_dir)
+    return state_dir
+
+# complete training state directories of state_root, oldest first
+def list_training_states(state_root):
+    if not os.path.exists(state_root):
+        return []
+    states = []
+    for entry in os.listdir(state_root):
+        path = os.path.join(state_root, entry)
+        if entry.startswith("step_") and entry[len("step_"):].isdigit() \
+                and os.path.exists(os.path.join(path, TRAINING_STATE_FILE_NAME)):
+            states.append((int(entry[len("step_"):]), path))
+    return [path for _, path in sorted(states)]
+
+def latest_training_state(state_root):
+    states = list_training_states(state_root)
+    return states[-1] if states else None
+
+# Restores every trainer from state_dir and returns the saved state with the reader positions.
+# expected holds saved extra values the run must match, e.g. {'fused': False}; a mismatch raises
+# ValueError before any trainer is restored
+def restore_training_state(state_dir, trainers, expected=None):
+    with open(os.path.join(state_dir, TRAINING_STATE_FILE_NAME), 'r') as f:
+        state = json.load(f)
+    for key, value in (expected or {}).items():
+        if key in state and state[key] != value:
+            raise ValueError("{0} was saved with {1}={2}, this run has {1}={3}".format(state_dir, key, state[key], value))
+    reader_states = None
+    for name, trainer in trainers.items():
+        external_state = trainer.restore_from_checkpoint(os.path.join(state_dir, state['trainers'][name]))
+        if external_state and 'readers' in external_state:
+            reader_states = external_state['readers']
+    state['readers'] = reader_states
+    return state
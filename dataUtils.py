@@ -1,9 +1,19 @@
+import argparse
 import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from PIL import Image
 
 file_endings = ['.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG']
 
+MAP_FILE_NAME = "map.txt"
+MANIFEST_FILE_NAME = "map_manifest.txt"
+
+TRAINING_FOLDER_X = "data/summer2winter_yosemite/trainA"
+TRAINING_FOLDER_Y = "data/summer2winter_yosemite/trainB"
+
 def create_class_mapping_from_folder(root_folder):
     classes = []
     for _, directories, _ in os.walk(root_folder):
@@ -11,20 +21,79 @@ def create_class_mapping_from_folder(root_folder):
             classes.append(directory)
     return np.asarray(classes)
 
-# create a map file from a flat folder, ie don't traverse subdirectories and don't add it to the path
-def create_map_file_from_flatfolder(folder):
-    map_file_name = os.path.join(folder, "map.txt")
-    with open(map_file_name , 'w') as map_file:
-        for entry in os.listdir(folder):
-            filename = os.path.join(folder, entry)
-            if os.path.isfile(filename) and os.path.splitext(filename)[1] in file_endings:
-                tempName = '\\\\'.join(filename.split('\\'))
-                tempName = '\\\\'.join(tempName.split('//'))
-                tempName = '\\\\'.join(tempName.split('/'))
-                map_file.write("{0}\t0\n".format(tempName))
+# map files are written with POSIX separators, CNTK readers accept them on every platform
+def posix_path(path):
+    return pathlib.PurePath(path).as_posix()
 
+# list the images of a flat folder as {name: (size, mtime_ns)}; os.scandir gives us the file type
+# without an extra stat, so only image files are stat-ed
+def scan_image_folder(folder):
+    images = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if os.path.splitext(entry.name)[1] in file_endings and entry.is_file():
+                stat = entry.stat()
+                images[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return images
 
-    return map_file_name
+def read_manifest(manifest_file_name):
+    manifest = {}
+    if os.path.exists(manifest_file_name):
+        with open(manifest_file_name, 'r') as manifest_file:
+            for line in manifest_file:
+                name, size, mtime = line.rstrip('\n').split('\t')
+                manifest[name] = (int(size), int(mtime))
+    return manifest
+
+def write_lines_atomic(file_name, lines):
+    temp_name = file_name + ".tmp"
+    with open(temp_name, 'w') as out_file:
+        out_file.writelines(lines)
+    os.replace(temp_name, file_name)
+
+# create or refresh map.txt of a flat folder, ie don't traverse subdirectories.
+# A small manifest (name, size, mtime) next to the map file remembers what was indexed last time,
+# so only new or removed files touch map.txt: new ones are appended, removed ones filtered out.
+def update_map_file(folder, label=0):
+    map_file_name = os.path.join(folder, MAP_FILE_NAME)
+    manifest_file_name = os.path.join(folder, MANIFEST_FILE_NAME)
+    indexed = read_manifest(manifest_file_name)
+    current = scan_image_folder(folder)
+
+    added = sorted(name for name in current if name not in indexed)
+    removed = set(name for name in indexed if name not in current)
+
+    def map_line(name):
+        return "{0}\t{1}\n".format(posix_path(os.path.join(folder, name)), label)
+
+    if not indexed or not os.path.exists(map_file_name):
+        # full rebuild: every current image, not only the ones the manifest has not seen yet,
+        # and all of them count as added
+        added = sorted(current)
+        write_lines_atomic(map_file_name, [map_line(name) for name in added])
+    elif removed:
+        removed_paths = set(posix_path(os.path.join(folder, name)) for name in removed)
+        with open(map_file_name, 'r') as map_file:
+            kept = [line for line in map_file if line.split('\t', 1)[0] not in removed_paths]
+        write_lines_atomic(map_file_name, kept + [map_line(name) for name in added])
+    elif added:
+        with open(map_file_name, 'a') as map_file:
+            map_file.writelines(map_line(name) for name in added)
+
+    if current != indexed:
+        write_lines_atomic(manifest_file_name,
+                           ["{0}\t{1}\t{2}\n".format(name, size, mtime)
+                            for name, (size, mtime) in sorted(current.items())])
+
+    return map_file_name, len(added), len(removed)
+
+# refresh the map files of many domain folders concurrently
+def update_map_files(folders, num_workers=None, label=0):
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(lambda folder: update_map_file(folder, label), folders))
+
+def create_map_file_from_flatfolder(folder):
+    return update_map_file(folder)[0]
 
 
 def create_map_file_from_folder(root_folder, class_mapping, include_unknown=False):
@@ -46,6 +115,8 @@ def create_map_file_from_folder(root_folder, class_mapping, include_unknown=Fals
 
     return map_file_name
 
+# CTF text version of the images of root_folder/<class>/; packedDataset.pack_class_folders writes the same
+# rows as binary arrays, about 4x smaller and without text parsing at read time
 def nparray_file_from_folder(root_folder, class_mapping, include_unknown=False):
     map_file_name = os.path.join(root_folder, "npArray_map.txt")
     labels = list(map(' '.join, np.eye(10, dtype=np.uint).astype(str)))
@@ -66,21 +137,23 @@ def nparray_file_from_folder(root_folder, class_mapping, include_unknown=False):
                         feature_str = feature_str.replace("\n", "")
                         label_str = labels[class_id]
                         res = '|labels {} |features {}\n'.format(label_str, feature_str)
-                        print(res)
                         map_file.writelines(res)
                         indx = indx + 1
-                        print("Processed file #{0} path {1}".format(indx, filename))
+                        if indx % 1000 == 0:
+                            print("Processed {0} files".format(indx))
 
     return map_file_name
 
-train_data = { }
-training_folder1 = "data//summer2winter_yosemite//trainA"
-training_folder2 = "data//summer2winter_yosemite//trainB"
-train_data['training_map'] = create_map_file_from_flatfolder(training_folder1)
-train_data['training_map'] = create_map_file_from_flatfolder(training_folder2)
-#train_data['training_map'] = create_map_file_from_flatfolder(training_folder2)
-#train_data['class_mapping'] = create_class_mapping_from_folder(training_folder1)
-#train_data['training_map'] = create_map_file_from_folder(training_folder, train_data['class_mapping'])
-#train_data['npArray_map'] = nparray_file_from_folder(training_folder, train_data['class_mapping'])
-
-print("done!")
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description="Create or incrementally update map.txt of flat image folders")
+    parser.add_argument('folders', nargs='*', default=[TRAINING_FOLDER_X, TRAINING_FOLDER_Y])
+    parser.add_argument('--workers', type=int, default=None, help="number of folders scanned concurrently")
+    parser.add_argument('--label', type=int, default=0)
+    args = parser.parse_args()
+
+    for map_file_name, num_added, num_removed in update_map_files(args.folders, args.workers, args.label):
+        print("{0}: {1} added, {2} removed".format(map_file_name, num_added, num_removed))
+    print("done!")
+
+if __name__ == '__main__':
+    main()
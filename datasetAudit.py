@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import dataUtils
+
+# Audits flat image folders (one per domain) for near-duplicate images within a domain and for images
+# that appear in more than one domain, using 64 bit difference hashes:
+# - hashes are computed in a process pool and kept in <folder>/dhash_index.txt next to map.txt, keyed by
+#   name, size and mtime like map_manifest.txt, so re-running only hashes new or changed files;
+# - near-duplicates are pairs within MAX_DISTANCE bits, found with multi-index hashing: the hash is cut
+#   into MAX_DISTANCE + 1 chunks, any two hashes that close agree on at least one chunk, so only images
+#   sharing a chunk value are compared;
+# - <folder>/map_audited.txt keeps one image per duplicate group and drops cross-domain collisions,
+#   in the map.txt format that create_mb_source reads.
+HASH_INDEX_FILE_NAME = "dhash_index.txt"
+AUDITED_MAP_FILE_NAME = "map_audited.txt"
+REPORT_FILE_NAME = "audit_report.json"
+HASH_SIZE = 8  # 8 x 8 gradient bits
+HASH_BITS = HASH_SIZE * HASH_SIZE
+MAX_DISTANCE = 4
+CHUNK_SIZE = 64  # images per task of the process pool
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale thumbnail
+def dhash(path):
+    img = Image.open(path)
+    img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # JPEG: decode at a reduced scale, much faster
+    pixels = np.asarray(img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hash_files(paths, num_workers=None):
+    if not paths:
+        return []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(dhash, paths, chunksize=CHUNK_SIZE))
+
+def read_hash_index(index_file_name):
+    index = {}
+    if os.path.exists(index_file_name):
+        with open(index_file_name, 'r') as index_file:
+            for line in index_file:
+                name, size, mtime, value = line.rstrip('\n').split('\t')
+                index[name] = (int(size), int(mtime), int(value, 16))
+    return index
+
+# {name: hash} of every image of folder, hashing only images that are new or changed since the last run
+def update_hash_index(folder, num_workers=None):
+    index_file_name = os.path.join(folder, HASH_INDEX_FILE_NAME)
+    indexed = read_hash_index(index_file_name)
+    current = dataUtils.scan_image_folder(folder)
+
+    stale = sorted(name for name, stat in current.items() if indexed.get(name, (None, None))[:2] != stat)
+    hashes = dict((name, indexed[name][2]) for name in current if name not in stale)
+    hashes.update(zip(stale, hash_files([os.path.join(folder, name) for name in stale], num_workers)))
+
+    if stale or len(indexed) != len(current):
+        dataUtils.write_lines_atomic(index_file_name,
+                                     ["{0}\t{1}\t{2}\t{3:016x}\n".format(name, size, mtime, hashes[name])
+                                      for name, (size, mtime) in sorted(current.items())])
+    print("{0}: {1} images, {2} hashed".format(folder, len(current), len(stale)))
+    return hashes
+
+def hamming_distance(a, b):
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+# bit ranges of the max_distance + 1 chunks of a hash
+def chunk_ranges(max_distance, num_bits=HASH_BITS):
+    bounds = np.linspace(0, num_bits, max_distance + 2).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# (i, j, distance) of every pair of hashes within max_distance bits, i < j.
+# Candidates of each chunk are checked right away, so only close pairs are kept and deduplicated.
+def find_near_pairs(hashes, max_distance=MAX_DISTANCE):
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    close_pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for start, end in chunk_ranges(max_distance):
+        keys = (hashes >> np.uint64(start)) & np.uint64((1 << (end - start)) - 1)
+        order = np.argsort(keys, kind='stable')
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        candidates = []
+        for bucket in np.split(order, boundaries):
+            if len(bucket) > 1:
+                first, second = np.triu_indices(len(bucket), 1)
+                candidates.append(np.stack([bucket[first], bucket[second]], axis=1))
+        if candidates:
+            candidates = np.concatenate(candidates)
+            close = hamming_distance(hashes[candidates[:, 0]], hashes[candidates[:, 1]]) <= max_distance
+            close_pairs.append(candidates[close])
+
+    pairs = np.unique(np.sort(np.concatenate(close_pairs), axis=1), axis=0)
+    return np.column_stack([pairs, hamming_distance(hashes[pairs[:, 0]], hashes[pairs[:, 1]])])
+
+# connected components of the pairs, as lists of indices with more than one member
+def duplicate_groups(num_items, pairs):
+    parent = list(range(num_items))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs[:, :2]:
+        parent[find(int(i))] = find(int(j))
+    components = {}
+    for i in range(num_items):
+        components.setdefault(find(i), []).append(i)
+    return [sorted(members) for members in components.values() if len(members) > 1]
+
+# Audits the domains and writes map_audited.txt into every folder; label is the map file label of all images
+def audit_folders(folders, max_distance=MAX_DISTANCE, num_workers=None, label=0):
+    paths, domains, hashes = [], [], []
+    for domain, folder in enumerate(folders):
+        for name, value in sorted(update_hash_index(folder, num_workers).items()):
+            paths.append(dataUtils.posix_path(os.path.join(folder, name)))
+            domains.append(domain)
+            hashes.append(value)
+    domains = np.array(domains, dtype=np.int64)
+
+    pairs = find_near_pairs(hashes, max_distance)
+    same_domain = domains[pairs[:, 0]] == domains[pairs[:, 1]]
+    duplicates = duplicate_groups(len(paths), pairs[same_domain])
+    collisions = pairs[~same_domain]
+
+    # keep the first image of every duplicate group, drop every image that collides with another domain
+    dropped = set(i for group in duplicates for i in group[1:])
+    dropped.update(int(i) for i in collisions[:, 0])
+    dropped.update(int(i) for i in collisions[:, 1])
+
+    map_files = []
+    for domain, folder in enumerate(folders):
+        map_file_name = os.path.join(folder, AUDITED_MAP_FILE_NAME)
+        dataUtils.write_lines_atomic(map_file_name, ["{0}\t{1}\n".format(paths[i], label)
+                                                     for i in np.flatnonzero(domains == domain) if i not in dropped])
+        map_files.append(map_file_name)
+
+    return {'max_distance': max_distance,
+            'images': len(paths),
+            'kept': len(paths) - len(dropped),
+            'map_files': map_files,
+            'duplicate_groups': [[paths[i] for i in group] for group in duplicates],
+            'cross_domain_collisions': [{'a': paths[i], 'b': paths[j], 'distance': int(d)}
+                                        for i, j, d in collisions]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Find near-duplicate and cross-domain images of flat image folders "
+                                                 "and write map files without them")
+    parser.add_argument('folders', nargs='*', default=[dataUtils.TRAINING_FOLDER_X, dataUtils.TRAINING_FOLDER_Y])
+    parser.add_argument('--max-distance', type=int, default=MAX_DISTANCE,
+                        help="largest Hamming distance of 64 bit hashes that counts as the same image")
+    parser.add_argument('--workers', type=int, default=None, help="hashing processes")
+    parser.add_argument('--label', type=int, default=0)
+    parser.add_argument('--report', default=REPORT_FILE_NAME, help="JSON report of every group and collision")
+    args = parser.parse_args()
+
+    report = audit_folders(args.folders, args.max_distance, args.workers, args.label)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("{0} images: {1} duplicate groups, {2} cross-domain collisions, {3} kept in {4}".format(
+        report['images'], len(report['duplicate_groups']), len(report['cross_domain_collisions']), report['kept'],
+        ", ".join(report['map_files'])))
+    print("Details in {0}".format(args.report))
+
+if __name__ == '__main__':
+    main()
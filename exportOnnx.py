@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+import cntk as C
+
+import imageCache
+import phaseTimer
+import translate
+
+PARITY_TOLERANCE = 1e-4  # generator outputs are 0..1
+BENCH_BATCH_SIZE = 8
+BENCH_STEPS = 20
+BENCH_WARMUP = 3
+
+def onnx_path(model_file):
+    return os.path.splitext(model_file)[0] + ".onnx"
+
+# Writes a G_G/G_F checkpoint as ONNX next to it (or to output_file), through a temporary file
+def export_onnx(model_file, output_file=None):
+    output_file = output_file or onnx_path(model_file)
+    model = C.load_model(model_file)
+    temp_file = output_file + ".tmp"
+    model.save(temp_file, format=C.ModelFormat.ONNX)
+    os.replace(temp_file, output_file)
+    print("Exported %s to %s" % (model_file, output_file))
+    return output_file
+
+def load_onnx(onnx_file):
+    return C.Function.load(onnx_file, format=C.ModelFormat.ONNX)
+
+# onnxruntime session of the exported model, None when onnxruntime is not installed
+def onnxruntime_session(onnx_file):
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    return onnxruntime.InferenceSession(onnx_file)
+
+def run_session(session, images):
+    output = session.run(None, {session.get_inputs()[0].name: images})[0]
+    return output.reshape((-1,) + output.shape[-3:])
+
+# Test inputs: the first batch_size images of a folder or map file, random 0..255 images otherwise
+def parity_images(model, source=None, batch_size=BENCH_BATCH_SIZE, seed=0):
+    height, width = model.arguments[0].shape[-2:]
+    if source:
+        paths = translate.list_images(source)[:batch_size]
+        return np.stack([imageCache.decode_image(path, height, width) for path in paths]).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(batch_size, 3, height, width)).astype(np.float32)
+
+# Max absolute difference of the exported model against the native one, through CNTK and onnxruntime
+def check_parity(native, onnx_file, images, tolerance=PARITY_TOLERANCE):
+    expected = translate.generate(native, images)
+    results = {'cntk_onnx': float(np.max(np.abs(translate.generate(load_onnx(onnx_file), images) - expected)))}
+    session = onnxruntime_session(onnx_file)
+    if session is not None:
+        results['onnxruntime'] = float(np.max(np.abs(run_session(session, images) - expected)))
+    for runtime, max_error in results.items():
+        print("%-12s max abs difference %.2e (%s)" % (runtime, max_error, "ok" if max_error <= tolerance else "FAILED"))
+    results['passed'] = all(max_error <= tolerance for max_error in results.values())
+    return results
+
+# Latency at batch 1 and throughput at images.shape[0] of every available runtime
+def benchmark(native, onnx_file, images, num_steps=BENCH_STEPS, num_warmup=BENCH_WARMUP):
+    runtimes = {'cntk': lambda batch: translate.generate(native, batch)}
+    exported = load_onnx(onnx_file)
+    runtimes['cntk_onnx'] = lambda batch: translate.generate(exported, batch)
+    session = onnxruntime_session(onnx_file)
+    if session is not None:
+        runtimes['onnxruntime'] = lambda batch: run_session(session, batch)
+
+    results = {}
+    for name, run in runtimes.items():
+        latency = phaseTimer.time_calls(lambda: run(images[:1]), num_steps, num_warmup)
+        batch = phaseTimer.time_calls(lambda: run(images), num_steps, num_warmup)
+        results[name] = {'latency_ms': float(np.median(latency)) * 1000,
+                         'images_per_sec': len(images) / float(np.median(batch))}
+        print("%-12s latency %.1f ms, %.2f images/sec at batch %d" %
+              (name, results[name]['latency_ms'], results[name]['images_per_sec'], len(images)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Export trained generators to ONNX and compare them on the CPU")
+    parser.add_argument('models', nargs='+', help="G_G_<step>.dnn / G_F_<step>.dnn files")
+    parser.add_argument('--images', default=None, help="folder or map file of parity/benchmark inputs, random if not set")
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE)
+    parser.add_argument('--bench', action='store_true', help="also time the native and the exported model")
+    parser.add_argument('--batch-size', type=int, default=BENCH_BATCH_SIZE)
+    parser.add_argument('--steps', type=int, default=BENCH_STEPS)
+    parser.add_argument('--output', default=None, help="write parity and benchmark results as JSON to this file")
+    args = parser.parse_args()
+
+    C.device.try_set_default_device(C.device.cpu())
+    results = {}
+    for model_file in args.models:
+        onnx_file = export_onnx(model_file)
+        native = C.load_model(model_file)
+        images = parity_images(native, args.images, args.batch_size)
+        results[model_file] = {'onnx': onnx_file, 'parity': check_parity(native, onnx_file, images, args.tolerance)}
+        if args.bench:
+            results[model_file]['benchmark'] = benchmark(native, onnx_file, images, args.steps)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not all(result['parity']['passed'] for result in results.values()):
+        raise SystemExit("ONNX export does not match the native model")
+
+if __name__ == '__main__':
+    main()
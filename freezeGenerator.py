@@ -0,0 +1,123 @@
+import argparse
+import os
+
+import numpy as np
+
+import cntk as C
+from cntk.logging.graph import depth_first_search
+
+import exportOnnx
+import generatorSpec
+import phaseTimer
+import translate
+
+CHECK_TOLERANCE = 1e-4  # generator outputs are 0..1
+
+def frozen_path(model_file):
+    return os.path.splitext(model_file)[0] + "_frozen.dnn"
+
+def is_layer(node):
+    return isinstance(node, C.Function) and node.is_block and (
+        node.op_name.startswith('Convolution') or node.op_name in ('BatchNormalization', 'LayerNormalization'))
+
+# Values of the parameters and constants of a layer block by name (W, scale, bias, aggregate_mean, ...)
+def block_values(block):
+    return dict((v.name, v.value) for v in block.inputs if v.is_parameter or v.is_constant)
+
+# Parameters of every generator layer, in the order of generatorSpec.LAYERS.
+# The generator is a chain, so the top level layer blocks found depth first from the output are the layers
+# in reverse order: a convolution block followed by its normalization block.
+def extract_layers(model):
+    blocks = list(reversed(depth_first_search(model, is_layer, depth=0)))
+    if len(blocks) != 2 * len(generatorSpec.LAYERS):
+        raise ValueError("%s does not look like trainCycleGAN.generator(): %d layer blocks" % (model, len(blocks)))
+    raw_layers = []
+    for (kind, norm, _, _), conv_block, norm_block in zip(generatorSpec.LAYERS, blocks[0::2], blocks[1::2]):
+        if ('Transpose' in conv_block.op_name) != (kind == 'transpose') or \
+                norm_block.op_name != ('BatchNormalization' if norm == 'bn' else 'LayerNormalization'):
+            raise ValueError("Unexpected layer %s/%s, expected %s/%s" % (conv_block.op_name, norm_block.op_name,
+                                                                         kind, norm))
+        values = block_values(norm_block)
+        raw = {'W': block_values(conv_block)['W'], 'scale': values['scale'], 'bias': values['bias']}
+        if norm == 'bn':
+            raw['mean'], raw['variance'] = values['aggregate_mean'], values['aggregate_variance']
+        raw_layers.append(raw)
+    return raw_layers
+
+def layer_norm(h, scale, bias, epsilon=generatorSpec.LAYERNORM_EPSILON):
+    centered = h - C.reduce_mean(h)
+    std = C.sqrt(C.reduce_mean(centered * centered))
+    # scale / (std + eps) and the bias in one multiply-add instead of normalize, scale and shift
+    return centered * (scale / (std + epsilon)) + bias
+
+# Inference-only generator from folded layers: convolutions with constant weights and biases, no batch
+# normalization statistics or learnable parameters, raw 0..255 BGR input like the trained generator
+def build_frozen(layers, image_shape):
+    x = C.input_variable(image_shape, name="real")
+    h = x
+    img_h, img_w = image_shape[-2:]
+    for i, layer in enumerate(layers):
+        strides = (1,) + tuple(layer['strides'])
+        W = C.constant(layer['W'])
+        if layer['kind'] == 'transpose':
+            # like generator(): transposed convolutions go back to img // (upsampling still to come)
+            later = [l['strides'] for l in layers[i + 1:] if l['kind'] == 'transpose']
+            output_shape = (layer['W'].shape[1], img_h // int(np.prod([s[0] for s in later])),
+                            img_w // int(np.prod([s[1] for s in later])))
+            h = C.convolution_transpose(W, h, strides=strides, auto_padding=[False, True, True],
+                                        output_shape=output_shape)
+        else:
+            h = C.convolution(W, h, strides=strides, auto_padding=[False, True, True])
+        if layer['layernorm']:
+            h = layer_norm(h, layer['ln_scale'], layer['ln_bias'])
+        else:
+            h = h + C.constant(layer['b'].reshape(-1, 1, 1))
+        if layer['relu']:
+            h = C.relu(h)
+    return C.combine([h])
+
+def freeze(model):
+    return build_frozen(generatorSpec.fold_generator(extract_layers(model)), model.arguments[0].shape)
+
+def save_frozen(frozen, output_file):
+    temp_file = output_file + ".tmp"
+    frozen.save(temp_file)
+    os.replace(temp_file, output_file)
+
+# Max absolute difference of the frozen generator against the original on the same inputs
+def check(model, frozen, images, tolerance=CHECK_TOLERANCE):
+    max_error = float(np.max(np.abs(translate.generate(frozen, images) - translate.generate(model, images))))
+    print("max abs difference %.2e (%s)" % (max_error, "ok" if max_error <= tolerance else "FAILED"))
+    return max_error <= tolerance
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold normalization into the convolutions of a trained generator")
+    parser.add_argument('model', help="G_G_<step>.dnn or G_F_<step>.dnn")
+    parser.add_argument('--output', default=None, help="default: <model>_frozen.dnn")
+    parser.add_argument('--check', action='store_true', help="compare frozen and original outputs")
+    parser.add_argument('--images', default=None, help="folder or map file of --check inputs, random if not set")
+    parser.add_argument('--tolerance', type=float, default=CHECK_TOLERANCE)
+    parser.add_argument('--bench', action='store_true', help="time both generators on the CPU")
+    parser.add_argument('--batch-size', type=int, default=exportOnnx.BENCH_BATCH_SIZE)
+    args = parser.parse_args()
+
+    C.device.try_set_default_device(C.device.cpu())
+    model = translate.load_generator(args.model)
+    frozen = freeze(model)
+    output_file = args.output or frozen_path(args.model)
+    save_frozen(frozen, output_file)
+    print("Saved %s: %.1f MB, original %.1f MB" % (output_file, os.path.getsize(output_file) / 1e6,
+                                                   os.path.getsize(args.model) / 1e6))
+
+    images = exportOnnx.parity_images(model, args.images, args.batch_size)
+    passed = check(model, frozen, images, args.tolerance) if args.check else True
+    if args.bench:
+        for name, generator in (('original', model), ('frozen', frozen)):
+            times = phaseTimer.time_calls(lambda: translate.generate(generator, images),
+                                          exportOnnx.BENCH_STEPS, exportOnnx.BENCH_WARMUP)
+            print("%-8s %.2f images/sec at batch %d" % (name, len(images) / float(np.median(times)), len(images)))
+    if not passed:
+        raise SystemExit("Frozen generator does not match %s" % args.model)
+
+if __name__ == '__main__':
+    main()
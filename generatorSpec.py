@@ -0,0 +1,128 @@
+import argparse
+
+import numpy as np
+
+# Layers of trainCycleGAN.generator() in the order data flows through them:
+# (convolution kind, normalization, strides, relu after the normalization)
+# c7s1-32, d64, d128, 9 resblocks of two 3x3 conv+layernorm (relu after the second), u64, u32, c7s1-3
+LAYERS = [('conv', 'bn', (1, 1), True),
+          ('conv', 'bn', (2, 2), True),
+          ('conv', 'bn', (2, 2), True)] + \
+         [('conv', 'layernorm', (1, 1), False), ('conv', 'layernorm', (1, 1), True)] * 9 + \
+         [('transpose', 'bn', (2, 2), True),
+          ('transpose', 'bn', (2, 2), True),
+          ('conv', 'bn', (1, 1), True)]
+
+INPUT_SCALE = 1.0 / 255  # build_graph feeds the generator real_X / 255
+BN_EPSILON = 1e-5
+LAYERNORM_EPSILON = 1e-5
+FOLD_TOLERANCE = 1e-5  # largest difference of check_folding, relative to the largest output value
+
+# Folds inference batch normalization, scale * (x - mean) / sqrt(variance + eps) + bias, into the weights
+# of the preceding bias-free convolution. Convolution weights are (out, in, kh, kw), transposed convolution
+# weights (in, out, kh, kw). Returns the folded weights and the per-channel bias.
+def fold_batch_norm(W, scale, bias, mean, variance, transpose=False, epsilon=BN_EPSILON):
+    factor = scale.reshape(-1) / np.sqrt(variance.reshape(-1) + epsilon)
+    shape = (1, -1, 1, 1) if transpose else (-1, 1, 1, 1)
+    folded_W = (W * factor.reshape(shape)).astype(np.float32)
+    folded_b = (bias.reshape(-1) - mean.reshape(-1) * factor).astype(np.float32)
+    return folded_W, folded_b
+
+# Inference layers from the parameters of every layer of LAYERS, as extracted from a trained generator:
+# dicts with 'W' and, for batch normalization, 'scale', 'bias', 'mean', 'variance', or for layer
+# normalization the scalar 'scale' and 'bias'. Batch normalization and the input scaling become part of
+# the convolution weights; layer normalization depends on each image and stays, with scalar parameters.
+def fold_generator(raw_layers):
+    if len(raw_layers) != len(LAYERS):
+        raise ValueError("Expected %d generator layers, got %d" % (len(LAYERS), len(raw_layers)))
+    layers = []
+    for i, ((kind, norm, strides, relu), raw) in enumerate(zip(LAYERS, raw_layers)):
+        W = np.asarray(raw['W'], dtype=np.float32)
+        if i == 0:
+            # zero padding is unaffected by the scaling, so it is exact to fold into the first convolution
+            W = W * np.float32(INPUT_SCALE)
+        layer = {'kind': kind, 'strides': strides, 'relu': relu, 'layernorm': norm == 'layernorm'}
+        if norm == 'bn':
+            layer['W'], layer['b'] = fold_batch_norm(W, raw['scale'], raw['bias'], raw['mean'], raw['variance'],
+                                                     transpose=kind == 'transpose')
+        else:
+            layer['W'], layer['b'] = W, None
+            layer['ln_scale'] = float(np.asarray(raw['scale']).reshape(-1)[0])
+            layer['ln_bias'] = float(np.asarray(raw['bias']).reshape(-1)[0])
+        layers.append(layer)
+    return layers
+
+def num_weights(layers):
+    return sum(layer['W'].size + (layer['b'].size if layer['b'] is not None else 2) for layer in layers)
+
+# Random raw layers for LAYERS: channels feature maps throughout, 3 in and out, batch normalization
+# statistics far from the identity so that folding mistakes show
+def random_raw_layers(rng, channels=8, kernel_size=3):
+    raw_layers = []
+    in_channels = 3
+    for i, (kind, norm, _, _) in enumerate(LAYERS):
+        out_channels = 3 if i == len(LAYERS) - 1 else channels
+        shape = (in_channels, out_channels) if kind == 'transpose' else (out_channels, in_channels)
+        std = np.sqrt(2.0 / (in_channels * kernel_size * kernel_size))
+        raw = {'W': rng.normal(0, std, shape + (kernel_size, kernel_size))}
+        if norm == 'bn':
+            raw.update(scale=rng.uniform(0.5, 1.5, out_channels), bias=rng.normal(0, 0.5, out_channels),
+                       mean=rng.normal(0, 0.5, out_channels), variance=rng.uniform(0.5, 2.0, out_channels))
+        else:
+            raw.update(scale=rng.uniform(0.5, 1.5, 1), bias=rng.normal(0, 0.5, 1))
+        raw_layers.append(dict((key, value.astype(np.float32)) for key, value in raw.items()))
+        in_channels = out_channels
+    return raw_layers
+
+# Runs random 0..255 images through random layers twice with the NumPy convolutions of numpyGenerator:
+# as trained (input scaling, convolution, batch normalization) and as folded by fold_generator.
+# Returns the largest difference relative to the largest output value; checks the folding without
+# CNTK or a trained model.
+def check_folding(image_size=16, batch_size=2, seed=0):
+    import numpyGenerator
+
+    def conv(h, W, kind, strides):
+        if kind == 'transpose':
+            return numpyGenerator.conv_transpose2d(h, np.ascontiguousarray(W.transpose(2, 3, 0, 1)), strides,
+                                                   (h.shape[1] * strides[0], h.shape[2] * strides[1]))
+        return numpyGenerator.conv2d(h, np.ascontiguousarray(W.transpose(2, 3, 1, 0)), strides)
+
+    rng = np.random.RandomState(seed)
+    raw_layers = random_raw_layers(rng)
+    images = rng.randint(0, 256, size=(batch_size, image_size, image_size, 3)).astype(np.float32)
+
+    reference = images * np.float32(INPUT_SCALE)
+    for (kind, norm, strides, relu), raw in zip(LAYERS, raw_layers):
+        reference = conv(reference, raw['W'], kind, strides)
+        if norm == 'bn':
+            reference = (reference - raw['mean']) / np.sqrt(raw['variance'] + np.float32(BN_EPSILON)) * raw['scale'] \
+                        + raw['bias']
+        else:
+            reference = numpyGenerator.layer_norm(reference, float(raw['scale'][0]), float(raw['bias'][0]))
+        if relu:
+            reference = np.maximum(reference, 0)
+
+    folded = images
+    for layer in fold_generator(raw_layers):
+        folded = conv(folded, layer['W'], layer['kind'], layer['strides'])
+        if layer['layernorm']:
+            folded = numpyGenerator.layer_norm(folded, layer['ln_scale'], layer['ln_bias'])
+        else:
+            folded += layer['b']
+        if layer['relu']:
+            folded = np.maximum(folded, 0)
+    return float(np.max(np.abs(folded - reference)) / max(np.max(np.abs(reference)), 1e-12))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check fold_generator against the unfolded layers on random weights")
+    parser.add_argument('--seeds', type=int, default=5, help="number of random generators checked")
+    parser.add_argument('--tolerance', type=float, default=FOLD_TOLERANCE)
+    args = parser.parse_args()
+
+    errors = [check_folding(seed=seed) for seed in range(args.seeds)]
+    print("max relative difference of folded and unfolded layers over %d seeds: %.2e" % (args.seeds, max(errors)))
+    if max(errors) > args.tolerance:
+        raise SystemExit("Folding differs by more than %.0e" % args.tolerance)
+
+if __name__ == '__main__':
+    main()
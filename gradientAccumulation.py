@@ -0,0 +1,74 @@
+import numpy as np
+
+# numpy view of feed data: CNTK Values from a MinibatchSource are copied to the host
+def as_array(data):
+    return data if isinstance(data, np.ndarray) else data.asarray()
+
+# Trains like trainer.train_minibatch, but splits each minibatch into micro-batches of micro_batch_size.
+# Every micro-batch runs forward and backward on its own and the gradients are summed on the host; the
+# trainer's learner then makes a single update for the whole minibatch. Peak activation memory depends on
+# the micro-batch size only, while the optimizer sees the full minibatch.
+# The wrapped trainer keeps the learner (and so the checkpointed learner state); this class stands in for it
+# in the training loop. The learner is updated directly, so the trainer's progress writers never see a
+# minibatch: ProgressPrinter and the TensorBoard loss summaries stay silent, only the values the training
+# loop writes itself from previous_minibatch_loss_average (the <prefix>/loss curves) are logged.
+class GradientAccumulator(object):
+    def __init__(self, trainer, micro_batch_size):
+        self.trainer = trainer
+        self.micro_batch_size = micro_batch_size
+        self.loss = trainer.loss_function
+        self.learners = trainer.parameter_learners
+        self.previous_minibatch_loss_average = 0.0
+        self.previous_minibatch_sample_count = 0
+
+    @property
+    def model(self):
+        return self.trainer.model
+
+    @property
+    def loss_function(self):
+        return self.loss
+
+    def train_minibatch(self, arguments):
+        arguments = dict((var, as_array(data)) for var, data in arguments.items() if var in self.loss.arguments)
+        num_samples = len(next(iter(arguments.values())))
+
+        parameters = set(p for learner in self.learners for p in learner.parameters)
+        gradients = None
+        loss_sum = 0.0
+        for start in range(0, num_samples, self.micro_batch_size):
+            micro_batch = dict((var, data[start:start + self.micro_batch_size]) for var, data in arguments.items())
+            state, outputs = self.loss.forward(micro_batch, outputs=[self.loss.output],
+                                               keep_for_backward=[self.loss.output], is_training=True)
+            loss_value = outputs[self.loss.output]
+            loss_sum += float(np.sum(loss_value))
+            micro_gradients = self.loss.backward(state, {self.loss.output: np.ones_like(loss_value)}, parameters)
+            if gradients is None:
+                gradients = dict((p, np.array(g)) for p, g in micro_gradients.items())
+            else:
+                for p, g in micro_gradients.items():
+                    gradients[p] += g
+
+        for learner in self.learners:
+            learner.update(dict((p, gradients[p]) for p in learner.parameters), num_samples)
+        self.previous_minibatch_loss_average = loss_sum / num_samples
+        self.previous_minibatch_sample_count = num_samples
+        return True
+
+    # nothing to summarize, see above
+    def summarize_training_progress(self):
+        pass
+
+    def save_checkpoint(self, filename, external_state=None):
+        self.trainer.save_checkpoint(filename, external_state or {})
+
+    def restore_from_checkpoint(self, filename):
+        return self.trainer.restore_from_checkpoint(filename)
+
+# Wraps each distinct trainer once, so trainers shared by the fused graph stay shared
+def wrap_trainers(trainers, micro_batch_size):
+    wrapped = {}
+    for trainer in trainers:
+        if id(trainer) not in wrapped:
+            wrapped[id(trainer)] = GradientAccumulator(trainer, micro_batch_size)
+    return [wrapped[id(trainer)] for trainer in trainers]
@@ -0,0 +1,146 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# A domain is packed once into <prefix>.npy, a (N, 3, H, W) uint8 array that is memory mapped at training
+# time, and <prefix>.index.txt, the source image of every row.
+CACHE_SUFFIX = ".npy"
+INDEX_SUFFIX = ".index.txt"
+
+NUM_CHANNELS = 3
+IMG_H, IMG_W = 256, 256
+PACK_CHUNK_SIZE = 256
+
+def cache_exists(cache_prefix):
+    return cache_prefix is not None and os.path.exists(cache_prefix + CACHE_SUFFIX) \
+           and os.path.exists(cache_prefix + INDEX_SUFFIX)
+
+def read_map_file(map_file):
+    with open(map_file, 'r') as f:
+        return [line.split('\t', 1)[0] for line in f if line.strip()]
+
+# decode an image the way ImageDeserializer + xforms.scale feed the network: resized, CHW, BGR channel order
+def decode_image(path, height=IMG_H, width=IMG_W):
+    img = Image.open(path).convert('RGB')
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)[..., ::-1].transpose(2, 0, 1)
+
+# decode every image of map_file once and store the domain as a fixed shape uint8 array.
+# Rows are stored in a random order, so that even unrandomized reads do not follow the map file order.
+def pack_domain(map_file, cache_prefix, height=IMG_H, width=IMG_W, num_workers=None, seed=0):
+    paths = read_map_file(map_file)
+    paths = [paths[i] for i in np.random.RandomState(seed).permutation(len(paths))]
+
+    temp_file_name = cache_prefix + ".tmp" + CACHE_SUFFIX
+    data = np.lib.format.open_memmap(temp_file_name, mode='w+', dtype=np.uint8,
+                                     shape=(len(paths), NUM_CHANNELS, height, width))
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for start in range(0, len(paths), PACK_CHUNK_SIZE):
+            chunk = paths[start:start + PACK_CHUNK_SIZE]
+            for i, img in enumerate(pool.map(lambda path: decode_image(path, height, width), chunk)):
+                data[start + i] = img
+            print("Packed {0} out of {1} images".format(start + len(chunk), len(paths)))
+    data.flush()
+    del data
+
+    with open(cache_prefix + INDEX_SUFFIX + ".tmp", 'w') as index_file:
+        index_file.writelines("{0}\n".format(path) for path in paths)
+    os.replace(temp_file_name, cache_prefix + CACHE_SUFFIX)
+    os.replace(cache_prefix + INDEX_SUFFIX + ".tmp", cache_prefix + INDEX_SUFFIX)
+    return cache_prefix + CACHE_SUFFIX
+
+# Drop-in replacement for the image MinibatchSource of a domain, reading from a packed cache.
+# Like ImageDeserializer(randomize=True), every sweep draws a new permutation of all images, so each
+# image meets different minibatch neighbours every sweep; a minibatch gathers its rows in file order,
+# each row a contiguous read of the memory map, straight into a new dtype array. That one copy is the
+# uint8 -> float32 conversion CNTK needs anyway. Without randomize and with dtype=None, minibatches
+# are slices of the memory map and nothing is copied.
+# For distributed training every worker opens the cache with the same seed and reads every
+# num_partitions-th minibatch of the sweep, starting at partition_index.
+class MemmapMinibatchSource(object):
+    def __init__(self, cache_prefix, randomize=True, seed=0, dtype=np.float32, num_partitions=1, partition_index=0):
+        self.data = np.load(cache_prefix + CACHE_SUFFIX, mmap_mode='r')
+        self.randomize = randomize
+        self.seed = seed
+        self.dtype = dtype
+        self.num_partitions = num_partitions
+        self.partition_index = partition_index
+        self.sweep = 0
+        self.position = 0
+        self._block_size = None
+        self._batches = None
+
+    @property
+    def num_samples(self):
+        return self.data.shape[0]
+
+    # rows of this worker's minibatches of the current sweep, one row of indices per minibatch
+    def _start_sweep(self, num_samples):
+        if self._block_size and num_samples != self._block_size:
+            # a new minibatch size, e.g. a run resumed with another --batch-size or --accumulate:
+            # continue the sweep after the images already read instead of at a stale minibatch index
+            self.position = self.position * self._block_size // num_samples
+        self._block_size = num_samples
+        if self.randomize:
+            order = np.random.RandomState(self.seed + self.sweep).permutation(self.num_samples)
+        else:
+            order = np.arange(self.num_samples)
+        num_batches = self.num_samples // num_samples
+        if num_batches < self.num_partitions:
+            raise ValueError("{0} cached images are too few for {1} workers".format(self.num_samples, self.num_partitions))
+        batches = order[:num_batches * num_samples].reshape(num_batches, num_samples)
+        self._batches = batches[self.partition_index::self.num_partitions][:num_batches // self.num_partitions]
+
+    def next_minibatch(self, num_samples):
+        if num_samples > self.num_samples:
+            raise ValueError("Minibatch size {0} exceeds the {1} cached images".format(num_samples, self.num_samples))
+        if self._batches is None or num_samples != self._block_size:
+            self._start_sweep(num_samples)
+        if self.position >= len(self._batches):
+            self.sweep += 1
+            self.position = 0
+            self._start_sweep(num_samples)
+
+        rows = self._batches[self.position]
+        self.position += 1
+        if not self.randomize:
+            batch = self.data[rows[0]:rows[0] + num_samples]
+            return batch if self.dtype is None else batch.astype(self.dtype)
+        batch = np.empty((num_samples,) + self.data.shape[1:], dtype=self.dtype or self.data.dtype)
+        for i, row in enumerate(np.sort(rows)):
+            batch[i] = self.data[row]
+        return batch
+
+    # same contract as MinibatchSource: the permutation of a sweep is derived from the seed,
+    # so the position within the sweep is all there is to save
+    def get_checkpoint_state(self):
+        return {'sweep': self.sweep, 'position': self.position, 'block_size': self._block_size or 0}
+
+    def restore_from_checkpoint(self, state):
+        self.sweep = int(state['sweep'])
+        self.position = int(state['position'])
+        self._batches = None
+        if int(state['block_size']) > 0:
+            self._start_sweep(int(state['block_size']))
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the images of a map file into a memory mapped uint8 cache")
+    parser.add_argument('map_file')
+    parser.add_argument('cache_prefix', nargs='?', default=None,
+                        help="defaults to 'images' next to the map file")
+    parser.add_argument('--height', type=int, default=IMG_H)
+    parser.add_argument('--width', type=int, default=IMG_W)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cache_prefix = args.cache_prefix or os.path.join(os.path.dirname(args.map_file), "images")
+    print("Wrote {0}".format(pack_domain(args.map_file, cache_prefix, args.height, args.width,
+                                         args.workers, args.seed)))
+
+if __name__ == '__main__':
+    main()
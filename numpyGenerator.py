@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+import dataUtils
+import generatorSpec
+import imageCache
+import phaseTimer
+import utils
+
+# A trained generator as a NumPy forward pass: no CNTK import and no graph to load, so short translation
+# jobs start in milliseconds. Weights come from an .npz written by export(), with batch normalization and
+# the input scaling already folded into the convolutions (generatorSpec.fold_generator).
+# Activations are NHWC float32 so that every convolution is a sum of matrix products over the kernel offsets.
+
+BATCH_SIZE = 8
+BENCH_STEPS = 10
+BENCH_WARMUP = 2
+
+def npz_path(model_file):
+    return os.path.splitext(model_file)[0] + ".npz"
+
+# Writes the folded weights of a G_G/G_F checkpoint; needs CNTK, unlike everything else in this module
+def export(model_file, output_file=None):
+    import cntk as C
+    import freezeGenerator
+
+    output_file = output_file or npz_path(model_file)
+    model = C.load_model(model_file)
+    layers = generatorSpec.fold_generator(freezeGenerator.extract_layers(model))
+    arrays = {'image_shape': np.asarray(model.arguments[0].shape)}
+    meta = []
+    for i, layer in enumerate(layers):
+        arrays['W%d' % i] = layer['W']
+        if layer['b'] is not None:
+            arrays['b%d' % i] = layer['b']
+        meta.append(dict((key, layer[key]) for key in ('kind', 'strides', 'relu', 'layernorm', 'ln_scale', 'ln_bias')
+                         if key in layer))
+    arrays['layers'] = np.asarray(json.dumps(meta))
+    temp_file = output_file + ".tmp.npz"
+    np.savez(temp_file, **arrays)
+    os.replace(temp_file, output_file)
+    print("Exported %s to %s (%.1f MB)" % (model_file, output_file, os.path.getsize(output_file) / 1e6))
+    return output_file
+
+class NumpyGenerator(object):
+    def __init__(self, npz_file):
+        with np.load(npz_file) as arrays:
+            self.image_shape = tuple(int(d) for d in arrays['image_shape'])
+            self.layers = json.loads(str(arrays['layers']))
+            for i, layer in enumerate(self.layers):
+                W = arrays['W%d' % i]
+                # (kh, kw, in, out) matrices per kernel offset; a transposed convolution maps its
+                # (in, out) weights the other way round
+                layer['W'] = np.ascontiguousarray(
+                    W.transpose(2, 3, 0, 1) if layer['kind'] == 'transpose' else W.transpose(2, 3, 1, 0))
+                layer['b'] = arrays['b%d' % i] if 'b%d' % i in arrays else None
+
+    # raw 0..255 BGR NCHW images in, 0..1 BGR NCHW images out, like the CNTK generator
+    def __call__(self, images):
+        h = np.ascontiguousarray(np.asarray(images, dtype=np.float32).transpose(0, 2, 3, 1))
+        img_h, img_w = self.image_shape[-2:]
+        for i, layer in enumerate(self.layers):
+            if layer['kind'] == 'transpose':
+                later = [l['strides'] for l in self.layers[i + 1:] if l['kind'] == 'transpose']
+                h = conv_transpose2d(h, layer['W'], layer['strides'],
+                                     (img_h // int(np.prod([s[0] for s in later])),
+                                      img_w // int(np.prod([s[1] for s in later]))))
+            else:
+                h = conv2d(h, layer['W'], layer['strides'])
+            if layer['layernorm']:
+                h = layer_norm(h, layer['ln_scale'], layer['ln_bias'])
+            else:
+                h += layer['b']
+            if layer['relu']:
+                np.maximum(h, 0, out=h)
+        return h.transpose(0, 3, 1, 2)
+
+# CNTK's auto padding centers the kernel on every stride-th input pixel starting at the first one
+def conv2d(x, W, strides):
+    kh, kw, _, num_out = W.shape
+    n, height, width, _ = x.shape
+    sh, sw = strides
+    out_h, out_w = -(-height // sh), -(-width // sw)
+    pad_top, pad_left = kh // 2, kw // 2
+    padded = np.pad(x, ((0, 0), (pad_top, max((out_h - 1) * sh + kh - height - pad_top, 0)),
+                        (pad_left, max((out_w - 1) * sw + kw - width - pad_left, 0)), (0, 0)))
+    out = np.zeros((n, out_h, out_w, num_out), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            out += np.matmul(padded[:, i:i + (out_h - 1) * sh + 1:sh, j:j + (out_w - 1) * sw + 1:sw], W[i, j])
+    return out
+
+# Gradient of conv2d: every input pixel adds its kernel-weighted contribution around pixel * stride
+def conv_transpose2d(x, W, strides, output_shape):
+    kh, kw, _, num_out = W.shape
+    n, height, width, _ = x.shape
+    sh, sw = strides
+    out_h, out_w = output_shape
+    pad_top, pad_left = kh // 2, kw // 2
+    padded_h = max(out_h + pad_top, (height - 1) * sh + kh)
+    padded_w = max(out_w + pad_left, (width - 1) * sw + kw)
+    out = np.zeros((n, padded_h, padded_w, num_out), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            out[:, i:i + (height - 1) * sh + 1:sh, j:j + (width - 1) * sw + 1:sw] += np.matmul(x, W[i, j])
+    return out[:, pad_top:pad_top + out_h, pad_left:pad_left + out_w]
+
+# LayerNormalization of trainCycleGAN: over all of an image, epsilon added to the standard deviation
+def layer_norm(x, scale, bias, epsilon=generatorSpec.LAYERNORM_EPSILON):
+    centered = x - x.mean(axis=(1, 2, 3), keepdims=True)
+    std = np.sqrt(np.mean(np.square(centered), axis=(1, 2, 3), keepdims=True))
+    centered *= scale / (std + epsilon)
+    centered += bias
+    return centered
+
+def encode_image(image, path):
+    Image.fromarray(utils.to_rgb_uint8(image)[0]).save(path)
+
+def translate_folder(generator, source, output_dir, batch_size=BATCH_SIZE):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    paths = imageCache.read_map_file(source) if os.path.isfile(source) else \
+        [os.path.join(source, name) for name in sorted(dataUtils.scan_image_folder(source))]
+    height, width = generator.image_shape[-2:]
+    start = time.perf_counter()
+    for i in range(0, len(paths), batch_size):
+        batch_paths = paths[i:i + batch_size]
+        outputs = generator(np.stack([imageCache.decode_image(path, height, width) for path in batch_paths]))
+        for path, output in zip(batch_paths, outputs):
+            encode_image(output, os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".png"))
+    elapsed = time.perf_counter() - start
+    print("%d images in %.1f s: %.2f images/sec" % (len(paths), elapsed, len(paths) / elapsed if elapsed else 0.0))
+
+# Load time and images/sec of the NumPy generator, and of the CNTK checkpoint when model_file is given
+def benchmark(npz_file, model_file=None, batch_size=BATCH_SIZE, num_steps=BENCH_STEPS, num_warmup=BENCH_WARMUP):
+    start = time.perf_counter()
+    generator = NumpyGenerator(npz_file)
+    results = {'numpy': {'load_s': time.perf_counter() - start}}
+    images = np.random.default_rng(0).integers(0, 256, size=(batch_size,) + generator.image_shape).astype(np.float32)
+    runtimes = {'numpy': generator}
+    if model_file:
+        start = time.perf_counter()
+        import cntk as C
+        model = C.load_model(model_file)
+        results['cntk'] = {'load_s': time.perf_counter() - start}
+        runtimes['cntk'] = lambda batch: np.asarray(model.eval({model.arguments[0]: batch})).reshape(
+            (-1,) + generator.image_shape)
+        max_error = float(np.max(np.abs(runtimes['numpy'](images) - runtimes['cntk'](images))))
+        results['max_abs_difference'] = max_error
+        print("max abs difference against %s: %.2e" % (model_file, max_error))
+
+    for name, run in runtimes.items():
+        times = phaseTimer.time_calls(lambda: run(images), num_steps, num_warmup)
+        results[name]['images_per_sec'] = batch_size / float(np.median(times))
+        print("%-6s load %.3f s, %.2f images/sec at batch %d" %
+              (name, results[name]['load_s'], results[name]['images_per_sec'], batch_size))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="CNTK-free generator inference with NumPy")
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser('export', help="write the folded weights of a checkpoint (needs CNTK)")
+    export_parser.add_argument('model', help="G_G_<step>.dnn or G_F_<step>.dnn")
+    export_parser.add_argument('--output', default=None, help="default: <model>.npz")
+    translate_parser = subparsers.add_parser('translate', help="translate a folder or map file of images")
+    translate_parser.add_argument('weights', help=".npz written by export")
+    translate_parser.add_argument('source', help="image folder or map file")
+    translate_parser.add_argument('output_dir')
+    translate_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    bench_parser = subparsers.add_parser('bench', help="load time and throughput, against CNTK with --model")
+    bench_parser.add_argument('weights', help=".npz written by export")
+    bench_parser.add_argument('--model', default=None, help="the exported .dnn, compared and timed with CNTK")
+    bench_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    bench_parser.add_argument('--steps', type=int, default=BENCH_STEPS)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args.model, args.output)
+    elif args.command == 'translate':
+        translate_folder(NumpyGenerator(args.weights), args.source, args.output_dir, args.batch_size)
+    elif args.command == 'bench':
+        benchmark(args.weights, args.model, args.batch_size, args.steps)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
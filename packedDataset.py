@@ -0,0 +1,99 @@
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+import dataUtils
+import imageCache
+
+# Packed form of the CTF text datasets (features and one-hot labels per line) and of class folders:
+# <prefix>.npy holds the features as an (N, D) array, uint8 when every value is a byte as for MNIST,
+# <prefix>.labels.npy the labels and <prefix>.index.txt the source of every row. The features file is
+# an imageCache cache, so imageCache.MemmapMinibatchSource reads it without parsing anything.
+LABELS_SUFFIX = ".labels.npy"
+FEATURES_STREAM = "features"
+LABELS_STREAM = "labels"
+
+# {stream name: values} of one CTF line, e.g. "|labels 0 1 0 |features 0 0 255 ..."
+def parse_ctf_line(line):
+    streams = {}
+    for field in line.split('|')[1:]:
+        values = field.split()
+        if values:
+            streams[values[0]] = np.array(values[1:], dtype=np.float32)
+    return streams
+
+def read_ctf(ctf_file):
+    with open(ctf_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield parse_ctf_line(line)
+
+# uint8 if the values are whole numbers in 0..255, float32 otherwise
+def packed_array(values):
+    values = np.asarray(values, dtype=np.float32)
+    if values.size and values.min() >= 0 and values.max() <= 255 and np.all(values == np.round(values)):
+        return values.astype(np.uint8)
+    return values
+
+# Writes features, labels and the index in the order of a seeded permutation, so that even unrandomized
+# reads are not in file order, each through a temporary file
+def write_packed(cache_prefix, features, labels, sources, seed=0):
+    order = np.random.RandomState(seed).permutation(len(features))
+    for suffix, array in ((imageCache.CACHE_SUFFIX, features), (LABELS_SUFFIX, labels)):
+        temp_file_name = cache_prefix + ".tmp" + suffix
+        np.save(temp_file_name, array[order])
+        os.replace(temp_file_name, cache_prefix + suffix)
+    dataUtils.write_lines_atomic(cache_prefix + imageCache.INDEX_SUFFIX,
+                                 ["{0}\n".format(sources[i]) for i in order])
+    return cache_prefix + imageCache.CACHE_SUFFIX
+
+# Packs a CTF file such as MNIST's Train-28x28_cntk_text.txt; the whole file is parsed once, here
+def pack_ctf(ctf_file, cache_prefix=None, features_stream=FEATURES_STREAM, labels_stream=LABELS_STREAM, seed=0):
+    cache_prefix = cache_prefix or os.path.splitext(ctf_file)[0]
+    features, labels = [], []
+    for streams in read_ctf(ctf_file):
+        features.append(streams[features_stream])
+        labels.append(streams[labels_stream])
+        if len(features) % 10000 == 0:
+            print("Parsed {0} lines of {1}".format(len(features), ctf_file))
+    sources = ["{0}:{1}".format(dataUtils.posix_path(ctf_file), i) for i in range(len(features))]
+    return write_packed(cache_prefix, packed_array(features), packed_array(labels), sources, seed)
+
+# Packs the images of root_folder/<class>/ with the layout of dataUtils.nparray_file_from_folder:
+# the raw pixels of every image flattened, with one-hot labels
+def pack_class_folders(root_folder, class_mapping, cache_prefix=None, seed=0):
+    cache_prefix = cache_prefix or os.path.join(root_folder, "npArray")
+    features, labels, sources = [], [], []
+    for class_id, class_name in enumerate(class_mapping):
+        folder = os.path.join(root_folder, class_name)
+        if not os.path.exists(folder):
+            continue
+        for name in sorted(dataUtils.scan_image_folder(folder)):
+            path = os.path.join(folder, name)
+            features.append(np.array(Image.open(path)).ravel())
+            labels.append(np.eye(len(class_mapping), dtype=np.uint8)[class_id])
+            sources.append(dataUtils.posix_path(path))
+    print("Packed {0} images of {1} classes".format(len(features), len(class_mapping)))
+    return write_packed(cache_prefix, packed_array(features), np.array(labels), sources, seed)
+
+def load_labels(cache_prefix):
+    return np.load(cache_prefix + LABELS_SUFFIX, mmap_mode='r')
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a CTF text file or class folders into .npy arrays")
+    parser.add_argument('source', help="CTF file, or a root folder with one folder per class")
+    parser.add_argument('cache_prefix', nargs='?', default=None,
+                        help="defaults to the CTF file without extension, or <folder>/npArray")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        class_mapping = dataUtils.create_class_mapping_from_folder(args.source)
+        print("Wrote {0}".format(pack_class_folders(args.source, class_mapping, args.cache_prefix, args.seed)))
+    else:
+        print("Wrote {0}".format(pack_ctf(args.source, args.cache_prefix, seed=args.seed)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+import time
+
+# Per-iteration phase timings of the training loop.
+# The loop calls start_step() and then lap(name) after each phase; a lap is the time since the previous
+# lap, so instrumenting costs one perf_counter call per phase. record() adds values measured elsewhere
+# (for example reader thread time) that are not part of the step's critical path.
+# Every `window` steps the mean and max of each phase are written to TensorBoard and as one line of JSON.
+class PhaseTimer(object):
+    def __init__(self, window=50, jsonl_path=None, tb_writer=None):
+        self.window = window
+        self.jsonl_path = jsonl_path
+        self.tb_writer = tb_writer
+        self._jsonl = open(jsonl_path, 'a') if jsonl_path else None
+        self._reset()
+        self._last = None
+        self._step_start = None
+
+    def _reset(self):
+        self._totals = {}
+        self._maxima = {}
+        self._values = {}
+        self._step_total = 0.0
+        self._num_steps = 0
+
+    def start_step(self):
+        self._step_start = self._last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self._totals[name] = self._totals.get(name, 0.0) + elapsed
+        if elapsed > self._maxima.get(name, 0.0):
+            self._maxima[name] = elapsed
+
+    def record(self, name, value):
+        self._values[name] = self._values.get(name, 0.0) + value
+
+    # closes the step; returns the window summary when the window is complete, None otherwise
+    def end_step(self, train_step):
+        self._step_total += time.perf_counter() - self._step_start
+        self._num_steps += 1
+        if self._num_steps < self.window:
+            return None
+        summary = self.summary(train_step)
+        self._write(summary)
+        self._reset()
+        return summary
+
+    def summary(self, train_step):
+        n = float(max(self._num_steps, 1))
+        step_mean = self._step_total / n
+        phases = dict((name, {'mean_ms': total / n * 1000, 'max_ms': self._maxima[name] * 1000,
+                              'share': total / self._step_total if self._step_total else 0.0})
+                      for name, total in self._totals.items())
+        values = dict((name, total / n) for name, total in self._values.items())
+        return {'step': train_step, 'steps': self._num_steps, 'step_ms': step_mean * 1000,
+                'phases': phases, 'values': values}
+
+    def _write(self, summary):
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(summary) + "\n")
+            self._jsonl.flush()
+        if self.tb_writer is not None:
+            step = summary['step']
+            self.tb_writer.write_value("time/step_ms", summary['step_ms'], step)
+            for name, phase in summary['phases'].items():
+                self.tb_writer.write_value("time/%s_ms" % name, phase['mean_ms'], step)
+            for name, value in summary['values'].items():
+                self.tb_writer.write_value("time/%s" % name, value, step)
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+# one line progress report of a window summary, phases sorted by their share of the step
+def format_summary(summary, num_steps):
+    phases = sorted(summary['phases'].items(), key=lambda item: -item[1]['share'])
+    return "Iteration %d out of %d: %.1f ms/step (%s)" % (
+        summary['step'], num_steps, summary['step_ms'],
+        ", ".join("%s %.0f%%" % (name, phase['share'] * 100) for name, phase in phases))
+
+# Wall clock seconds of num_steps calls of fn, after num_warmup untimed calls
+def time_calls(fn, num_steps, num_warmup):
+    for _ in range(num_warmup):
+        fn()
+    times = []
+    for _ in range(num_steps):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
@@ -0,0 +1,74 @@
+import queue
+import threading
+import time
+
+# Loads paired (X, Y) minibatches ahead of the training loop.
+# Each domain gets its own loader thread (a CNTK MinibatchSource must not be read from two threads at once)
+# and a bounded queue of `depth` batches; next() pairs the heads of both queues.
+# depth=0 disables the threads and loads synchronously, which is handy for debugging.
+class PairedPrefetcher(object):
+    def __init__(self, load_X, load_Y, depth=4):
+        self.depth = depth
+        self.stall_time = 0.0      # seconds next() spent waiting for data
+        self.last_stall_time = 0.0
+        self.load_time = [0.0, 0.0]  # seconds spent inside load_X / load_Y
+        self.num_batches = 0
+        self._loaders = [load_X, load_Y]
+        self._stop = threading.Event()
+        self._queues = []
+        self._threads = []
+        if depth > 0:
+            for i in range(2):
+                q = queue.Queue(maxsize=depth)
+                t = threading.Thread(target=self._produce, args=(i, q), daemon=True)
+                self._queues.append(q)
+                self._threads.append(t)
+                t.start()
+
+    def _load(self, i):
+        start = time.perf_counter()
+        item = self._loaders[i]()
+        self.load_time[i] += time.perf_counter() - start
+        return item
+
+    def _produce(self, i, q):
+        while not self._stop.is_set():
+            try:
+                item = (self._load(i), None)
+            except Exception as e:
+                item = (None, e)
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[1] is not None:
+                return
+
+    def _get(self, q):
+        item, error = q.get()
+        if error is not None:
+            raise error
+        return item
+
+    # number of complete (X, Y) pairs ready to be consumed
+    @property
+    def queue_depth(self):
+        return min(q.qsize() for q in self._queues) if self._queues else 0
+
+    def next(self):
+        start = time.perf_counter()
+        if self._queues:
+            batch = (self._get(self._queues[0]), self._get(self._queues[1]))
+        else:
+            batch = (self._load(0), self._load(1))
+        self.last_stall_time = time.perf_counter() - start
+        self.stall_time += self.last_stall_time
+        self.num_batches += 1
+        return batch
+
+    def close(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
@@ -0,0 +1,131 @@
+import os
+import re
+import sys
+from contextlib import contextmanager
+
+import cntk as C
+from cntk.logging.graph import depth_first_search
+
+PROFILE_DIR = "tblogs_profile"
+TOP_N = 20
+
+_MS_PATTERN = re.compile(r'([0-9]*\.?[0-9]+)\s*ms')
+
+# CNTK prints node timings from native code, so sys.stdout redirection does not see them;
+# swap the process level stdout/stderr file descriptors instead
+@contextmanager
+def capture_native_output(path):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open(path, 'w') as f:
+        saved = [os.dup(1), os.dup(2)]
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved:
+                os.close(fd)
+
+_UID_PATTERN = re.compile(r'[A-Za-z_]+[0-9]+')
+
+# name of a part of a named layer, e.g. d64/conv; unnamed layers keep unnamed parts
+def part_name(name, part):
+    return name + '/' + part if name else ''
+
+# {uid: layer} of every named node of function and of every node inside a named layer block, e.g. the
+# convolution primitive inside the d64/conv block of trainCycleGAN.generator maps to d64/conv.
+# Output uids are included, the node timing report may name a node by either.
+def layer_names(function):
+    names = {}
+
+    def add(node, name):
+        names[node.uid] = name
+        for output in node.outputs:
+            names[output.uid] = name
+
+    for node in depth_first_search(function, lambda f: isinstance(f, C.Function) and f.name != '', depth=0):
+        add(node, node.name)
+        if node.is_block:
+            for inner in depth_first_search(node.block_root, lambda f: isinstance(f, C.Function), depth=-1):
+                add(inner, node.name)
+    return names
+
+# layer of a node of the timing report: the named layer it belongs to if names knows one of its uids,
+# otherwise its name without the numeric uid suffix, e.g. Convolution1234 -> Convolution
+def layer_name(node_name, names=None):
+    names = names or {}
+    if node_name in names.values():
+        return node_name
+    for uid in _UID_PATTERN.findall(node_name):
+        if uid in names:
+            return names[uid]
+    return re.sub(r'[_]?[0-9]+$', '', node_name) or node_name
+
+# (node, ms) of every line of a node timing report that names a node and reports milliseconds;
+# forward and backward times of a node are added up
+def parse_node_timing(path):
+    timings = []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            times = _MS_PATTERN.findall(line)
+            if fields and times:
+                timings.append((fields[0], sum(float(t) for t in times)))
+    return timings
+
+# the top_n layers by total milliseconds; names from layer_names() groups the nodes by layer
+def top_layers(timings, names=None, top_n=TOP_N):
+    totals = {}
+    for node, ms in timings:
+        layer = layer_name(node, names)
+        totals[layer] = totals.get(layer, 0.0) + ms
+    return sorted(totals.items(), key=lambda item: -item[1])[:top_n]
+
+# Turns CNTK's profiler and per-node timing on for num_steps steps starting at start_step.
+# The training loop calls before_step/after_step with the step number; at the end of the window the
+# node timing report of every function in `functions` goes to <log_dir>/node_timing_<name>.txt and the
+# top_n most expensive layers are printed.
+class StepProfiler(object):
+    def __init__(self, functions, start_step=10, num_steps=20, log_dir=PROFILE_DIR, top_n=TOP_N):
+        self.functions = functions
+        self.start_step = start_step
+        self.end_step = start_step + num_steps
+        self.log_dir = log_dir
+        self.top_n = top_n
+        self.active = False
+
+    def before_step(self, train_step):
+        if train_step == self.start_step:
+            if not os.path.exists(self.log_dir):
+                os.makedirs(self.log_dir)
+            C.debugging.start_profiler(dir=self.log_dir, sync_gpu=True)
+            C.debugging.enable_profiler()
+            C.debugging.set_node_timing(True)
+            self.active = True
+            print("Profiling iterations %d to %d into %s" % (self.start_step, self.end_step - 1, self.log_dir))
+
+    def after_step(self, train_step):
+        if self.active and train_step == self.end_step - 1:
+            self.stop()
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        C.debugging.disable_profiler()
+        C.debugging.stop_profiler()
+
+        for name, function in self.functions.items():
+            report_file = os.path.join(self.log_dir, "node_timing_%s.txt" % name)
+            with capture_native_output(report_file):
+                function.print_node_timing()
+            print("Top %d layers of %s (ms over %d iterations), full report in %s" %
+                  (self.top_n, name, self.end_step - self.start_step, report_file))
+            for layer, ms in top_layers(parse_node_timing(report_file), layer_names(function), self.top_n):
+                print("  %-40s %10.2f" % (layer, ms))
+        C.debugging.set_node_timing(False)
@@ -1,7 +1,6 @@
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 import os
+import imageCache
 import utils
 
 import cntk as C
@@ -51,6 +50,8 @@ if not data_found:
     raise ValueError("Please generate the data by completing CNTK 103 Part A")
 
 print("Data directory is {0}".format(data_dir))
+# written by `python packedDataset.py <train_file>`, read instead of the CTF text when it exists
+packed_prefix = os.path.splitext(train_file)[0]
 
 
 def create_reader(path, is_training, input_dim, label_dim):
@@ -69,6 +70,18 @@ def create_reader(path, is_training, input_dim, label_dim):
     )
 
 
+def create_packed_reader(cache_prefix, is_training):
+    return imageCache.MemmapMinibatchSource(cache_prefix, randomize=is_training)
+
+
+# Next minibatch of features, None for the short last minibatch of a CTF sweep
+def next_features(reader, input_var, num_samples):
+    if isinstance(reader, imageCache.MemmapMinibatchSource):
+        return reader.next_minibatch(num_samples)
+    data = reader.next_minibatch(num_samples, {input_var: reader.streams.features})
+    return data[input_var].data if data[input_var].num_samples == num_samples else None
+
+
 np.random.seed(123)
 
 
@@ -230,15 +243,14 @@ def train(reader_train, generator, discriminator):
 
     k = 2
 
-    input_map = {X_real: reader_train.streams.features}
     for train_step in range(NUM_MINIBATCHES):
 
         # train the discriminator model for k steps
         for gen_train_step in range(k):
             Z_data = noise_sample(MINIBATCH_SIZE)
-            X_data = reader_train.next_minibatch(MINIBATCH_SIZE, input_map)
-            if X_data[X_real].num_samples == Z_data.shape[0]:
-                batch_inputs = {X_real: X_data[X_real].data, Z: Z_data}
+            X_data = next_features(reader_train, X_real, MINIBATCH_SIZE)
+            if X_data is not None:
+                batch_inputs = {X_real: X_data, Z: Z_data}
                 D_trainer.train_minibatch(batch_inputs)
 
         # train the generator model for a single step
@@ -264,7 +276,11 @@ def train(reader_train, generator, discriminator):
     return Z, X_fake, G_trainer_loss
 
 
-reader_train = create_reader(train_file, True, D_INPUT_DIM, label_dim=10)
+if os.path.exists(packed_prefix + imageCache.CACHE_SUFFIX):
+    print("Reading packed data from {0}".format(packed_prefix + imageCache.CACHE_SUFFIX))
+    reader_train = create_packed_reader(packed_prefix, True)
+else:
+    reader_train = create_reader(train_file, True, D_INPUT_DIM, label_dim=10)
 
 # G_input, G_output, G_trainer_loss = train(reader_train, dense_generator, dense_discriminator)
 G_input, G_output, G_trainer_loss = train(reader_train,
@@ -1,3 +1,9 @@
+import argparse
+import os
+from collections import deque
+
+import numpy as np
+
 import cntk as C
 from cntk import Trainer
 from cntk.layers import default_options
@@ -11,25 +17,46 @@ from cntk.learners import (adam, UnitType, learning_rate_schedule,
 from cntk.logging import ProgressPrinter, TensorBoardProgressWriter
 import cntk.io.transforms as xforms
 
+import batchSizeFinder
+import checkpoints
+import gradientAccumulation
+import imageCache
+import phaseTimer
+import profiling
+import prefetch
 import utils
 
-C.device.try_set_default_device(C.device.gpu(0))
-
 L1_lambda = 10
 
 # training config
 MINIBATCH_SIZE = 4
+ACCUMULATION_STEPS = 1  # micro-batches of MINIBATCH_SIZE whose gradients make one update, see --accumulate
 NUM_MINIBATCHES = 500000
 PROGRESS_SAVE_STEP = 20
+LOG_PARAMS_STEP = 20  # parameter statistics are written to TensorBoard every LOG_PARAMS_STEP steps
 MODEL_SAVE_STEP = 200
+KEEP_LAST_CHECKPOINTS = 5  # most recent model checkpoints kept on disk
+KEEP_BEST_CHECKPOINTS = 3  # checkpoints with the lowest generator loss kept on disk
+BEST_METRIC_WINDOW = 200  # steps the generator loss is averaged over to rank checkpoints
+STATE_SAVE_STEP = 200  # full training state (learners, readers, step) for --resume
+KEEP_LAST_STATES = 2
+FUSED_TRAINING = False  # one generator and one discriminator update per step instead of four trainers
+PREFETCH_DEPTH = 4  # (X, Y) minibatches loaded ahead by background threads, 0 to load synchronously
 
 MODELS_DIR = './trained_models'
+TRAINING_STATE_DIR = './trained_models/state'
 GENERATED_IMAGES_DIR = "./generated_images"
+TIMING_WINDOW = 50  # steps aggregated per phase timing report
+TIMING_LOG_FILE = "train_timings.jsonl"
+SAMPLE_CONTACT_SHEET = True  # one tiled PNG per batch instead of a folder of PNGs per model and step
 
 LR = 0.0002
 MOMENTUM = 0.5  # equivalent to beta1
 MAP_FILE_X = "data//summer2winter_yosemite//trainA//map.txt"
 MAP_FILE_Y = "data//summer2winter_yosemite//trainB//map.txt"
+# packed uint8 caches written by imageCache.py, used instead of the map files when present
+IMAGE_CACHE_X = "data/summer2winter_yosemite/trainA/images"
+IMAGE_CACHE_Y = "data/summer2winter_yosemite/trainB/images"
 
 TB_LOGDIR_G_F = "tblogs_G_F"
 TB_LOGDIR_G_G = "tblogs_G_G"
@@ -49,69 +76,103 @@ def create_mb_source(map_file, num_classes = 10, randomize=True):
         labels=StreamDef(field='label', shape=num_classes))),
                            randomize=randomize)
 
-def conv(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    c = Convolution(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False)(input)
+# Reads a domain from its packed image cache if there is one, otherwise decodes the images of the map file
+def create_reader(map_file, cache_prefix, num_workers=1, worker_rank=0):
+    if imageCache.cache_exists(cache_prefix):
+        print("Reading images from cache %s" % cache_prefix)
+        return imageCache.MemmapMinibatchSource(cache_prefix, num_partitions=num_workers, partition_index=worker_rank)
+    return create_mb_source(map_file)
+
+# Next minibatch of num_samples images per worker as feed data for input_var
+def next_images(reader, input_var, num_samples, num_workers=1, worker_rank=0):
+    if isinstance(reader, imageCache.MemmapMinibatchSource):
+        return reader.next_minibatch(num_samples)
+    return reader.next_minibatch(num_samples * num_workers, {input_var: reader.streams.features},
+                                 num_data_partitions=num_workers, partition_index=worker_rank)[input_var].data
+
+# Next minibatch together with the reader position after it, so that a prefetched batch knows
+# which reader state to checkpoint once it has been trained on
+def next_images_with_state(reader, input_var, num_samples, num_workers=1, worker_rank=0):
+    data = next_images(reader, input_var, num_samples, num_workers, worker_rank)
+    return data, reader.get_checkpoint_state()
+
+# Feed data as an (N, C, H, W) array
+def as_images(data):
+    if not isinstance(data, np.ndarray):
+        data = data.asarray()
+    return data.reshape((-1,) + IMAGE_DIMS)
+
+# Layer blocks are named <layer>/conv, <layer>/bn, <layer>/ln and <layer>/relu (e.g. d64/conv, R128_3.conv1/ln),
+# so that profiling.top_layers reports time per layer instead of per op type
+def conv(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    c = Convolution(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False,
+                    name=profiling.part_name(name, 'conv'))(input)
     return c
 
-def conv_bn(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    c = Convolution(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False)(input)
-    r = BatchNormalization(map_rank=1, normalization_time_constant=4096, use_cntk_engine=False)(c)
+def conv_bn(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    c = conv(input, filter_size, num_filters, strides, init, name)
+    r = BatchNormalization(map_rank=1, normalization_time_constant=4096, use_cntk_engine=False,
+                           name=profiling.part_name(name, 'bn'))(c)
     return r
 
-def conv_layernorm(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    c = Convolution(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False)(input)
-    r = LayerNormalization()(c)
+def conv_layernorm(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    c = conv(input, filter_size, num_filters, strides, init, name)
+    r = LayerNormalization(name=profiling.part_name(name, 'ln'))(c)
     return r
 
-def conv_bn_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    r = conv_bn(input, filter_size, num_filters, strides, init)
-    return relu(r)
+def conv_bn_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    r = conv_bn(input, filter_size, num_filters, strides, init, name)
+    return relu(r, name=profiling.part_name(name, 'relu'))
 
-def conv_bn_leaky_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    r = conv_bn(input, filter_size, num_filters, strides, init)
-    return leaky_relu(r)
+def conv_bn_leaky_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    r = conv_bn(input, filter_size, num_filters, strides, init, name)
+    return leaky_relu(r, name=profiling.part_name(name, 'relu'))
 
-def conv_leaky_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal()):
-    r = conv(input, filter_size, num_filters, strides, init)
-    return leaky_relu(r)
+def conv_leaky_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal(), name=''):
+    r = conv(input, filter_size, num_filters, strides, init, name)
+    return leaky_relu(r, name=profiling.part_name(name, 'relu'))
 
 
-def conv_frac_bn(input, filter_size, num_filters, strides=(1,1), init=he_normal(), output_shape=None):
-    c = ConvolutionTranspose2D(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False, output_shape=output_shape)(input)
-    r = BatchNormalization(map_rank=1, normalization_time_constant=4096, use_cntk_engine=False)(c)
+def conv_frac_bn(input, filter_size, num_filters, strides=(1,1), init=he_normal(), output_shape=None, name=''):
+    c = ConvolutionTranspose2D(filter_size, num_filters, activation=None, init=init, pad=True, strides=strides, bias=False,
+                               output_shape=output_shape, name=profiling.part_name(name, 'conv'))(input)
+    r = BatchNormalization(map_rank=1, normalization_time_constant=4096, use_cntk_engine=False,
+                           name=profiling.part_name(name, 'bn'))(c)
     return r
 
-def conv_fract_bn_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal(), output_shape=None):
-    r = conv_frac_bn(input, filter_size, num_filters, strides, init, output_shape)
-    return relu(r)
+def conv_fract_bn_relu(input, filter_size, num_filters, strides=(1,1), init=he_normal(), output_shape=None, name=''):
+    r = conv_frac_bn(input, filter_size, num_filters, strides, init, output_shape, name)
+    return relu(r, name=profiling.part_name(name, 'relu'))
 
-def resblock_basic(input, num_filters):
-    c1 = conv_layernorm(input, (3,3), num_filters)
-    c2 = conv_layernorm(c1, (3, 3), num_filters)
-    return relu(c2)
+def resblock_basic(input, num_filters, name=''):
+    c1 = conv_layernorm(input, (3,3), num_filters, name=name + '.conv1' if name else '')
+    c2 = conv_layernorm(c1, (3, 3), num_filters, name=name + '.conv2' if name else '')
+    return relu(c2, name=profiling.part_name(name, 'relu'))
 
+# blocks named R<num_filters>_1 .. R<num_filters>_<num_stack_layers>
 def resblock_basic_stack(input, num_stack_layers, num_filters):
     assert (num_stack_layers >= 0)
     l = input
-    for _ in range(num_stack_layers):
-        l = resblock_basic(l, num_filters)
+    for i in range(num_stack_layers):
+        l = resblock_basic(l, num_filters, name='R%d_%d' % (num_filters, i + 1))
     return l
 
 def generator(h0):
     with default_options(init=C.normal(scale=0.02)):
         print('Generator input shape: ', h0.shape)
+        img_h, img_w = h0.shape[-2:]
 
         # c7s1-32,d64,d128,R128,R128,R128, R128,R128,R128,R128,R128,R128,u64,u32,c7s1-3
         # c7s1-32
-        h1 = conv_bn_relu(h0, (7,7), 32)
+        h1 = conv_bn_relu(h0, (7,7), 32, name='c7s1_32')
         print('h1 shape', h1.shape)
 
         # d64
-        h2 = conv_bn_relu(h1, (3,3), 64, strides=(2,2))
+        h2 = conv_bn_relu(h1, (3,3), 64, strides=(2,2), name='d64')
         print('h2 shape', h2.shape)
 
         # d128
-        h3 = conv_bn_relu(h2, (3,3), 128, strides=(2,2))
+        h3 = conv_bn_relu(h2, (3,3), 128, strides=(2,2), name='d128')
         print('h3 shape', h3.shape)
 
         # R128 x 9
@@ -119,15 +180,15 @@ def generator(h0):
         print('h4 shape', h4.shape)
 
         # u64
-        h5 = conv_fract_bn_relu(h4, (3,3), 64, (2, 2),  output_shape=(128, 128))
+        h5 = conv_fract_bn_relu(h4, (3,3), 64, (2, 2),  output_shape=(img_h // 2, img_w // 2), name='u64')
         print('h5 shape', h5.shape)
 
         # u32
-        h6 = conv_fract_bn_relu(h5, (3,3), 32, (2, 2), output_shape=(IMG_H, IMG_W))
+        h6 = conv_fract_bn_relu(h5, (3,3), 32, (2, 2), output_shape=(img_h, img_w), name='u32')
         print('h6 shape', h6.shape)
 
         # c7s1-3
-        h7 = conv_bn_relu(h6, (7,7), 3)
+        h7 = conv_bn_relu(h6, (7,7), 3, name='c7s1_3')
         print('h7 shape', h7.shape)
         return h7
 
@@ -137,26 +198,27 @@ def discriminator(h0):
     with default_options(init=C.normal(scale=0.02)):
         print('Discriminator input shape: ', h0.shape)
 
-        h1 = conv_leaky_relu(h0, (4,4), 64, strides=(2,2))
+        h1 = conv_leaky_relu(h0, (4,4), 64, strides=(2,2), name='C64')
         print('h1 shape', h1.shape)
 
-        h2 = conv_bn_leaky_relu(h1, (4,4), 128, strides=(2,2))
+        h2 = conv_bn_leaky_relu(h1, (4,4), 128, strides=(2,2), name='C128')
         print('h2 shape', h2.shape)
 
-        h3 = conv_bn_leaky_relu(h2, (4,4), 256, strides=(2,2))
+        h3 = conv_bn_leaky_relu(h2, (4,4), 256, strides=(2,2), name='C256')
         print('h3 shape', h3.shape)
 
-        h4 = conv_bn_leaky_relu(h3, (4,4), 512, strides=(2,2))
+        h4 = conv_bn_leaky_relu(h3, (4,4), 512, strides=(2,2), name='C512')
         print('h4 shape', h4.shape)
 
-        h5 = conv(h4, (1,1), 1, strides=(1,1))
+        h5 = conv(h4, (1,1), 1, strides=(1,1), name='C1')
         print('h5 shape', h5.shape)
 
-        h6 = Dense(1, activation=C.sigmoid)(h5)
+        h6 = Dense(1, activation=C.sigmoid, name='out')(h5)
         print('h6 shape', h6.shape)
         return h6
 
-def build_graph(image_shape, generator, discriminator):
+# TensorBoard logs go to the TB_LOGDIR_* folders under log_dir, or to a run_name subfolder of each
+def build_graph(image_shape, generator, discriminator, fused=False, distributed=False, log_dir=".", run_name=None):
     input_dynamic_axes = [C.Axis.default_batch_axis()]
     real_X = C.input(image_shape, dynamic_axes=input_dynamic_axes, name="real_X")
     real_Y = C.input(image_shape, dynamic_axes=input_dynamic_axes, name="real_Y")
@@ -225,40 +287,77 @@ def build_graph(image_shape, generator, discriminator):
     DX_loss_fake = reduce_mean(square(DX_fake_sample - 1.0))
     DX_loss = (DX_loss_real + DX_loss_fake) / 2
 
-    DX_optim= adam(DX_loss.parameters,
-        lr=learning_rate_schedule(LR, UnitType.sample),
-        momentum=momentum_schedule(0.5))
+    # Data parallel training: every learner aggregates gradients across workers, only rank 0 logs
+    rank = C.Communicator.rank() if distributed else None
 
-    DY_optim = adam(DY_loss.parameters,
-                    lr=learning_rate_schedule(LR, UnitType.sample),
-                    momentum=momentum_schedule(0.5))
-    G_optim = adam(g_loss_G.parameters,
-                    lr=learning_rate_schedule(LR, UnitType.sample),
-                    momentum=momentum_schedule(0.5))
-
-    F_optim = adam(g_loss_F.parameters,
-                    lr=learning_rate_schedule(LR, UnitType.sample),
-                   momentum=momentum_schedule(0.5))
+    def create_learner(parameters):
+        learner = adam(parameters,
+                       lr=learning_rate_schedule(LR, UnitType.sample),
+                       momentum=momentum_schedule(0.5))
+        if distributed:
+            learner = C.train.distributed.data_parallel_distributed_learner(learner)
+        return learner
 
     # Setup Tensor Board
+    def tb_log_dir(name):
+        return os.path.join(log_dir, name, run_name) if run_name else os.path.join(log_dir, name)
+
     print_frequency_mbsize = NUM_MINIBATCHES // 25
-    pp_G_G = [ProgressPrinter(print_frequency_mbsize)]
-    pp_G_F = [ProgressPrinter(print_frequency_mbsize)]
-    pp_D_X = [ProgressPrinter(print_frequency_mbsize)]
-    pp_D_Y = [ProgressPrinter(print_frequency_mbsize)]
+    pp_G_G = [ProgressPrinter(print_frequency_mbsize, rank=rank)]
+    pp_G_F = [ProgressPrinter(print_frequency_mbsize, rank=rank)]
+    pp_D_X = [ProgressPrinter(print_frequency_mbsize, rank=rank)]
+    pp_D_Y = [ProgressPrinter(print_frequency_mbsize, rank=rank)]
 
-    tb_G_G = TensorBoardProgressWriter(freq=10, log_dir=TB_LOGDIR_G_G, model=genG)
+    tb_G_G = TensorBoardProgressWriter(freq=10, log_dir=tb_log_dir(TB_LOGDIR_G_G), rank=rank, model=genG)
     pp_G_G.append(tb_G_G)
 
-    tb_G_F = TensorBoardProgressWriter(freq=10, log_dir=TB_LOGDIR_G_F, model=genG)
+    tb_G_F = TensorBoardProgressWriter(freq=10, log_dir=tb_log_dir(TB_LOGDIR_G_F), rank=rank, model=genG)
     pp_G_F.append(tb_G_F)
 
-    tb_D_X = TensorBoardProgressWriter(freq=10, log_dir=TB_LOGDIR_D_X, model=DX)
+    tb_D_X = TensorBoardProgressWriter(freq=10, log_dir=tb_log_dir(TB_LOGDIR_D_X), rank=rank, model=DX)
     pp_D_X.append(tb_D_X)
 
-    tb_D_Y = TensorBoardProgressWriter(freq=10, log_dir=TB_LOGDIR_D_Y, model=DY)
+    tb_D_Y = TensorBoardProgressWriter(freq=10, log_dir=tb_log_dir(TB_LOGDIR_D_Y), rank=rank, model=DY)
     pp_D_Y.append(tb_D_Y)
 
+    if fused:
+        # One generator update computes genG, genF, both cycle reconstructions and both L1 terms once
+        # and updates G and F from the same forward/backward pass; one discriminator update does D_X and D_Y.
+        # G_G_trainer/G_F_trainer and D_X_trainer/D_Y_trainer are then the same trainer.
+        # As with the four trainers, each learner holds every parameter its loss depends on: the generator
+        # losses reach the discriminators and the discriminator losses reach the generators through the
+        # fake samples, so only the shared forward/backward pass differs between the modes.
+        g_loss = reduce_mean(square(discY_fake - 1.0)) \
+                + reduce_mean(square(discX_fake - 1.0)) \
+                + L1_lambda * reduce_mean(abs(real_X_scaled - genF_back)) \
+                + L1_lambda * reduce_mean(abs(real_Y_scaled - genG_back))
+        d_loss = DX_loss + DY_loss
+
+        G_optim = F_optim = create_learner(g_loss.parameters)
+        DX_optim = DY_optim = create_learner(d_loss.parameters)
+
+        G_G_trainer = G_F_trainer = Trainer(
+            C.combine([genG, genF]),
+            (g_loss, None),
+            G_optim,
+            progress_writers=pp_G_G
+        )
+        D_X_trainer = D_Y_trainer = Trainer(
+            C.combine([DX, DY]),
+            (d_loss, None),
+            DX_optim,
+            progress_writers=pp_D_X
+        )
+
+        return (real_X, real_Y, genF, genG, real_X_scaled, real_Y_scaled,
+                DX_optim, DY_optim, G_optim, F_optim, G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer,
+                tb_G_G, tb_G_F, tb_D_X, tb_D_Y, DX, DY)
+
+    DX_optim = create_learner(DX_loss.parameters)
+    DY_optim = create_learner(DY_loss.parameters)
+    G_optim = create_learner(g_loss_G.parameters)
+    F_optim = create_learner(g_loss_F.parameters)
+
     # Instantiate the trainers
     G_G_trainer = Trainer(
         genG,
@@ -292,60 +391,189 @@ def build_graph(image_shape, generator, discriminator):
 
     return (real_X, real_Y, genF, genG, real_X_scaled, real_Y_scaled,
             DX_optim, DY_optim, G_optim, F_optim, G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer,
-            tb_G_G, tb_G_F, tb_D_X, tb_D_Y)
-
-def train():
-    print("Starting training")
-
-    reader_train_X = create_mb_source(MAP_FILE_X)
-    reader_train_Y = create_mb_source(MAP_FILE_Y)
+            tb_G_G, tb_G_F, tb_D_X, tb_D_Y, DX, DY)
+
+# Drops repeated trainers, keeping the first occurrence: with the fused graph G_G/G_F and D_X/D_Y share a trainer
+def unique_trainers(trainers, key=lambda trainer: trainer):
+    unique = []
+    for item in trainers:
+        if all(key(item) is not key(other) for other in unique):
+            unique.append(item)
+    return unique
+
+def train(fused=FUSED_TRAINING, resume=False, profile_start=None, profile_steps=20, distributed=False,
+          accumulation_steps=ACCUMULATION_STEPS, minibatch_size=MINIBATCH_SIZE):
+    # with distributed training every worker reads its own share of the data and only
+    # rank 0 writes checkpoints, sample images and logs
+    num_workers = C.Communicator.num_workers() if distributed else 1
+    worker_rank = C.Communicator.rank() if distributed else 0
+    is_chief = worker_rank == 0
+    if is_chief:
+        print("Starting training" + (" on %d workers" % num_workers if distributed else ""))
+
+    reader_train_X = create_reader(MAP_FILE_X, IMAGE_CACHE_X, num_workers, worker_rank)
+    reader_train_Y = create_reader(MAP_FILE_Y, IMAGE_CACHE_Y, num_workers, worker_rank)
+    state_dir = checkpoints.latest_training_state(TRAINING_STATE_DIR) if resume else None
+    # CNTK's progress writers count their updates from 0 again after a restore, so a resumed run writes to
+    # a resumed_step_<n> subfolder of every tblogs_* folder, a run of its own in TensorBoard, instead of
+    # drawing its minibatch/avg_loss curves over the first run's. The <prefix>/loss, parameter and timing
+    # values are written against the absolute step and continue where the previous run stopped.
+    run_name = "resumed_" + os.path.basename(state_dir) if state_dir is not None else None
     real_X, real_Y, genF, genG, real_X_scaled, real_Y_scaled, \
             DX_optim, DY_optim, G_optim, F_optim, \
             G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer, \
-            tb_G_G, tb_G_F, tb_D_X, tb_D_Y = build_graph(image_shape=IMAGE_DIMS,generator=generator, discriminator=discriminator)
-
-    input_map_X = {real_X: reader_train_X.streams.features}
-    input_map_Y = {real_Y: reader_train_Y.streams.features}
-    for train_step in range(NUM_MINIBATCHES):
-        print("Iteration %d out of %d"%(train_step, NUM_MINIBATCHES))
-        X_data = reader_train_X.next_minibatch(MINIBATCH_SIZE, input_map_X)
-        batch_inputs_X = {real_X: X_data[real_X].data}
-        Y_data = reader_train_Y.next_minibatch(MINIBATCH_SIZE, input_map_Y)
-        batch_inputs_Y = {real_Y: Y_data[real_Y].data}
-        batch_inputs_X_Y = {real_X : X_data[real_X].data, real_Y : Y_data[real_Y].data}
-        G_G_trainer.train_minibatch(batch_inputs_X_Y)
-        D_Y_trainer.train_minibatch(batch_inputs_X_Y)  #
-        G_F_trainer.train_minibatch(batch_inputs_X_Y)
-        D_X_trainer.train_minibatch(batch_inputs_X_Y)
-
-        G_G_trainer.summarize_training_progress()
-        D_X_trainer.summarize_training_progress()
-
-        G_F_trainer.summarize_training_progress()
-        D_Y_trainer.summarize_training_progress()
-
-        utils.logTensorBoard(G_G_trainer, tb_G_G, "G_G", train_step)
-        utils.logTensorBoard(D_X_trainer, tb_D_X, "D_X", train_step)
-        utils.logTensorBoard(G_F_trainer, tb_G_G, "G_F", train_step)
-        utils.logTensorBoard(D_Y_trainer, tb_D_Y, "D_Y", train_step)
+            tb_G_G, tb_G_F, tb_D_X, tb_D_Y, DX, DY = build_graph(image_shape=IMAGE_DIMS,generator=generator,
+                                                                 discriminator=discriminator, fused=fused,
+                                                                 distributed=distributed, run_name=run_name)
+    if accumulation_steps > 1:
+        # minibatches of minibatch_size * accumulation_steps, trained as micro-batches of minibatch_size
+        G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer = gradientAccumulation.wrap_trainers(
+            [G_G_trainer, G_F_trainer, D_X_trainer, D_Y_trainer], minibatch_size)
+    batch_size = minibatch_size * accumulation_steps
+    update_order = unique_trainers([(G_G_trainer, "G_G"), (D_Y_trainer, "D_Y"), (G_F_trainer, "G_F"), (D_X_trainer, "D_X")],
+                                   key=lambda item: item[0])
+    log_order = unique_trainers([(G_G_trainer, tb_G_G, "G_G"), (D_X_trainer, tb_D_X, "D_X"),
+                                 (G_F_trainer, tb_G_G, "G_F"), (D_Y_trainer, tb_D_Y, "D_Y")],
+                                key=lambda item: item[0])
+    named_trainers = dict((prefix, trainer) for trainer, _, prefix in log_order)
+
+    start_step = 0
+    if state_dir is not None:
+        state = checkpoints.restore_training_state(state_dir, named_trainers, expected={'fused': fused})
+        reader_train_X.restore_from_checkpoint(state['readers']['X'])
+        reader_train_Y.restore_from_checkpoint(state['readers']['Y'])
+        start_step = state['train_step'] + 1
+        print("Resuming from %s at iteration %d" % (state_dir, start_step))
+
+    prefetcher = prefetch.PairedPrefetcher(
+        lambda: next_images_with_state(reader_train_X, real_X, batch_size, num_workers, worker_rank),
+        lambda: next_images_with_state(reader_train_Y, real_Y, batch_size, num_workers, worker_rank),
+        depth=PREFETCH_DEPTH)
+    checkpoint_writer = sample_writer = None
+    if is_chief:
+        checkpoint_writer = checkpoints.CheckpointWriter(MODELS_DIR, keep_last=KEEP_LAST_CHECKPOINTS,
+                                                         keep_best=KEEP_BEST_CHECKPOINTS)
+        sample_writer = utils.SampleWriter(GENERATED_IMAGES_DIR, contact_sheet=SAMPLE_CONTACT_SHEET)
+    timer = phaseTimer.PhaseTimer(TIMING_WINDOW, TIMING_LOG_FILE if is_chief else None, tb_G_G if is_chief else None)
+    profiler = None
+    if profile_start is not None and is_chief:
+        profiler = profiling.StepProfiler(dict((name, trainer.loss_function) for trainer, name in update_order),
+                                          max(profile_start, start_step), profile_steps)
+    load_time_X, load_time_Y = prefetcher.load_time
+    generator_losses = deque(maxlen=BEST_METRIC_WINDOW)
+    for train_step in range(start_step, NUM_MINIBATCHES):
+        if profiler is not None:
+            profiler.before_step(train_step)
+        timer.start_step()
+        (X_data, X_reader_state), (Y_data, Y_reader_state) = prefetcher.next()
+        timer.lap("input_wait")
+        # next_minibatch time of the reader threads, overlapped with training unless input_wait grows
+        timer.record("read_X_ms", (prefetcher.load_time[0] - load_time_X) * 1000)
+        timer.record("read_Y_ms", (prefetcher.load_time[1] - load_time_Y) * 1000)
+        timer.record("queue_depth", prefetcher.queue_depth)
+        load_time_X, load_time_Y = prefetcher.load_time
+
+        batch_inputs_X_Y = {real_X : X_data, real_Y : Y_data}
+        for trainer, name in update_order:
+            trainer.train_minibatch(batch_inputs_X_Y)
+            timer.lap(name)
+
+        for trainer, tb_writer, prefix in log_order:
+            trainer.summarize_training_progress()
+            if is_chief:
+                # written against the absolute step, so the curves continue seamlessly after --resume
+                tb_writer.write_value(prefix + "/loss", trainer.previous_minibatch_loss_average, train_step)
+                utils.logTensorBoard(trainer, tb_writer, prefix, train_step, LOG_PARAMS_STEP)
+        timer.lap("logging")
 
         G_G_trainer_loss = G_G_trainer.previous_minibatch_loss_average
         G_F_trainer_loss = G_F_trainer.previous_minibatch_loss_average
-
-        if (train_step > 0 and train_step % PROGRESS_SAVE_STEP == 0):
-            generated_images_G = genG.eval(batch_inputs_X)  # G(X) -> Y~
-            utils.save_generated_images(generated_images_G, "G", train_step, GENERATED_IMAGES_DIR)
-            generated_images_F = genF.eval(batch_inputs_Y)
-            utils.save_generated_images(generated_images_F, "F", train_step, GENERATED_IMAGES_DIR)
-
-            # Uncomment to get the input images saved to dis
-            utils.save_generated_images(X_data[real_X].value[0], "real_X", train_step, GENERATED_IMAGES_DIR)
-            utils.save_generated_images(Y_data[real_Y].value[0], "real_Y", train_step, GENERATED_IMAGES_DIR)
-
-        if (train_step > 0 and train_step % MODEL_SAVE_STEP == 0):
+        generator_losses.append(sum(trainer.previous_minibatch_loss_average
+                                    for trainer in unique_trainers([G_G_trainer, G_F_trainer])))
+
+        if (is_chief and train_step > 0 and train_step % PROGRESS_SAVE_STEP == 0):
+            # at most minibatch_size samples, accumulated minibatches can be much larger
+            sample_X = as_images(X_data)[:minibatch_size]
+            sample_Y = as_images(Y_data)[:minibatch_size]
+            generated_images_G = genG.eval({real_X: sample_X})  # G(X) -> Y~
+            sample_writer.submit(generated_images_G, "G", train_step)
+            generated_images_F = genF.eval({real_Y: sample_Y})
+            sample_writer.submit(generated_images_F, "F", train_step)
+
+            # input images are 0..255, generated ones 0..1
+            sample_writer.submit(sample_X / 255, "real_X", train_step)
+            sample_writer.submit(sample_Y / 255, "real_Y", train_step)
+            timer.lap("sampling")
+
+        if (is_chief and train_step > 0 and train_step % MODEL_SAVE_STEP == 0):
             print("Saving current model at iteration %d" % train_step)
-            utils.save_trained_models([G_G_trainer.model, G_F_trainer.model, D_X_trainer.model, D_Y_trainer.model],
-                        ["G_G", "G_F", "D_X", "D_Y"], '%d' % train_step, MODELS_DIR)
+            # the loss of a single minibatch of a few images is mostly noise, keep-best ranks by the recent mean
+            checkpoint_writer.save([genG, genF, DX, DY], ["G_G", "G_F", "D_X", "D_Y"], '%d' % train_step,
+                                   metric=float(np.mean(generator_losses)))
+            timer.lap("checkpoint")
+
+        if (train_step > 0 and train_step % STATE_SAVE_STEP == 0):
+            checkpoints.save_training_state(TRAINING_STATE_DIR, train_step, named_trainers,
+                                            {'X': X_reader_state, 'Y': Y_reader_state},
+                                            keep_last=KEEP_LAST_STATES, is_chief=is_chief,
+                                            extra={'fused': fused})
+            timer.lap("training_state")
+
+        summary = timer.end_step(train_step)
+        if profiler is not None:
+            profiler.after_step(train_step)
+        if summary is not None and is_chief:
+            print(phaseTimer.format_summary(summary, NUM_MINIBATCHES))
+
+    prefetcher.close()
+    if is_chief:
+        checkpoint_writer.close()
+        sample_writer.close()
+    timer.close()
+    if profiler is not None:
+        profiler.stop()
+    if distributed:
+        C.train.distributed.Communicator.finalize()
+
+def select_device(use_gpu=True, device_id=0):
+    if use_gpu:
+        C.device.try_set_default_device(C.device.gpu(device_id))
+    else:
+        C.device.try_set_default_device(C.device.cpu())
 
 if __name__ == '__main__':
-    train()
+    parser = argparse.ArgumentParser(description="Train CycleGAN")
+    parser.add_argument('--cpu', action='store_true', help="train on the CPU instead of GPU 0")
+    parser.add_argument('--fused', action='store_true', default=FUSED_TRAINING,
+                        help="update both generators and both discriminators in one pass each")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue from the latest training state in %s" % TRAINING_STATE_DIR)
+    parser.add_argument('--profile', action='store_true',
+                        help="profile a window of iterations with CNTK's profiler, reports go to %s" % profiling.PROFILE_DIR)
+    parser.add_argument('--profile-start', type=int, default=10, help="first profiled iteration")
+    parser.add_argument('--profile-steps', type=int, default=20, help="number of profiled iterations")
+    parser.add_argument('--distributed', action='store_true',
+                        help="data parallel training, launch with: mpiexec -n <workers> python trainCycleGAN.py --distributed")
+    parser.add_argument('--batch-size', default=str(MINIBATCH_SIZE),
+                        help="minibatch size, or 'auto' for the fastest size within --memory-budget-mb "
+                             "found by batchSizeFinder.py")
+    parser.add_argument('--memory-budget-mb', type=float, default=None,
+                        help="peak memory budget of --batch-size auto, default %d%% of the physical memory" %
+                             (batchSizeFinder.MEMORY_FRACTION * 100))
+    parser.add_argument('--accumulate', type=int, default=ACCUMULATION_STEPS,
+                        help="accumulate the gradients of this many micro-batches of --batch-size per update; "
+                             "above 1, progress printing and CNTK's loss summaries stop and only the "
+                             "<trainer>/loss TensorBoard values are logged")
+    args = parser.parse_args()
+    if args.batch_size == 'auto' and args.distributed:
+        parser.error("--batch-size auto probes in child processes; run batchSizeFinder.py once and pass the size")
+    if args.batch_size == 'auto':
+        minibatch_size = batchSizeFinder.auto_batch_size(IMAGE_DIMS[-1], args.cpu, args.fused, args.memory_budget_mb)
+    else:
+        minibatch_size = int(args.batch_size)
+
+    # one GPU per local worker
+    select_device(not args.cpu, C.Communicator.rank() if args.distributed else 0)
+    train(fused=args.fused, resume=args.resume,
+          profile_start=args.profile_start if args.profile else None, profile_steps=args.profile_steps,
+          distributed=args.distributed, accumulation_steps=args.accumulate, minibatch_size=minibatch_size)
@@ -1,8 +1,9 @@
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+import argparse
 import numpy as np
 import os
-os.chdir('/home/pctds/gitrepos/cntk-cyclegan')
+
+import imageCache
+import profiling
 import utils
 
 import cntk as C
@@ -19,13 +20,14 @@ from cntk.logging import ProgressPrinter, TensorBoardProgressWriter
 
 import cntk.io.transforms as xforms
 
-C.device.try_set_default_device(C.device.gpu(0))
 TB_LOGDIR_G = "tblogs_G"
 TB_LOGDIR_D = "tblogs_D"
 MAP_FILE = "data//trainingMNIST//map.txt"
+IMAGE_CACHE = "data/trainingMNIST/images"  # `python imageCache.py data/trainingMNIST/map.txt --height 28 --width 28`
 
 isFast = True
 PROGRESS_SAVE_STEP = 500
+LOG_PARAMS_STEP = 20  # parameter statistics are written to TensorBoard every LOG_PARAMS_STEP steps
 
 # architectural parameters
 NUM_CHANNELS = 3
@@ -42,16 +44,7 @@ MINIBATCH_SIZE = 128
 NUM_MINIBATCHES = 5000 if isFast else 10000
 LR = 0.0002
 MOMENTUM = 0.5  # equivalent to beta1
-
-data_found = False
-
-if os.path.isfile(MAP_FILE):
-    data_found = True
-
-if not data_found:
-    raise ValueError("Can not file map file {0}".format(MAP_FILE))
-
-print("Map file is {0}".format(MAP_FILE))
+NOISE_SEED = 123
 
 # Creates a minibatch source for training or testing
 def create_mb_source(map_file, num_classes, randomize=True):
@@ -63,15 +56,38 @@ def create_mb_source(map_file, num_classes, randomize=True):
                            randomize=randomize)
 
 
-np.random.seed(123)
-
-
-def noise_sample(num_samples):
-    return np.random.uniform(
-        low=-1.0,
-        high=1.0,
-        size=[num_samples, G_INPUT_DIM]
-    ).astype(np.float32)
+# Reads the packed image cache if there is one, otherwise decodes the images of the map file
+def create_reader(map_file, cache_prefix, num_classes):
+    if imageCache.cache_exists(cache_prefix):
+        print("Reading images from cache %s" % cache_prefix)
+        return imageCache.MemmapMinibatchSource(cache_prefix)
+    return create_mb_source(map_file, num_classes)
+
+# Next minibatch of images, None for a short minibatch of the image reader
+def next_images(reader, input_var, num_samples):
+    if isinstance(reader, imageCache.MemmapMinibatchSource):
+        return reader.next_minibatch(num_samples)
+    data = reader.next_minibatch(num_samples, {input_var: reader.streams.features})
+    return data[input_var].data if data[input_var].num_samples == num_samples else None
+
+
+# Uniform [-1, 1) generator input, drawn as float32 straight into a preallocated buffer per batch size.
+# The returned array is reused by the next sample() of the same size, so it is only valid until then;
+# train_minibatch/eval copy their inputs, which is all the training loop needs.
+class NoiseSampler(object):
+    def __init__(self, dim=G_INPUT_DIM, seed=NOISE_SEED):
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+        self._buffers = {}
+
+    def sample(self, num_samples):
+        buffer = self._buffers.get(num_samples)
+        if buffer is None:
+            buffer = self._buffers[num_samples] = np.empty((num_samples, self.dim), dtype=np.float32)
+        self.rng.random(out=buffer, dtype=np.float32)
+        buffer *= 2
+        buffer -= 1
+        return buffer
 
 
 # We expect the kernel shapes to be square in this tutorial and
@@ -87,17 +103,19 @@ else:
     raise ValueError('This tutorial needs same stride in all dims')
 
 
-# Helper functions
-def bn_with_relu(x, activation=C.relu):
-    h = BatchNormalization(map_rank=1)(x)
-    return C.relu(h)
+# Helper functions; as in trainCycleGAN, named layers get <layer>/bn and <layer>/relu blocks so that
+# --profile reports time per layer
+def bn_with_relu(x, activation=C.relu, name=''):
+    h = BatchNormalization(map_rank=1, name=profiling.part_name(name, 'bn'))(x)
+    return C.relu(h, name=profiling.part_name(name, 'relu'))
 
 
 # We use param-relu function to use a leak=0.2 since CNTK implementation
 # of Leaky ReLU is fixed to 0.01
-def bn_with_leaky_relu(x, leak=0.2):
-    h = BatchNormalization(map_rank=1)(x)
-    r = C.param_relu(C.constant((np.ones(h.shape) * leak).astype(np.float32)), h)
+def bn_with_leaky_relu(x, leak=0.2, name=''):
+    h = BatchNormalization(map_rank=1, name=profiling.part_name(name, 'bn'))(x)
+    r = C.param_relu(C.constant((np.ones(h.shape) * leak).astype(np.float32)), h,
+                     name=profiling.part_name(name, 'relu'))
     return r
 
 
@@ -110,12 +128,12 @@ def convolutional_generator(z):
         gfc_dim = 1024
         gf_dim = 64
 
-        h0 = Dense(gfc_dim, activation=None)(z)
-        h0 = bn_with_relu(h0)
+        h0 = Dense(gfc_dim, activation=None, name='G_fc1024/dense')(z)
+        h0 = bn_with_relu(h0, name='G_fc1024')
         print('h0 shape', h0.shape)
 
-        h1 = Dense([gf_dim * 2, s_h4, s_w4], activation=None)(h0)
-        h1 = bn_with_relu(h1)
+        h1 = Dense([gf_dim * 2, s_h4, s_w4], activation=None, name='G_fc128x7x7/dense')(h0)
+        h1 = bn_with_relu(h1, name='G_fc128x7x7')
         print('h1 shape', h1.shape)
 
         h2 = ConvolutionTranspose2D((gkernel,gkernel),
@@ -123,8 +141,9 @@ def convolutional_generator(z):
                                     strides=(gstride, gstride),
                                     pad=True,
                                     output_shape=(s_h2, s_w2),
-                                    activation=None)(h1)
-        h2 = bn_with_relu(h2)
+                                    activation=None,
+                                    name='G_u128/conv')(h1)
+        h2 = bn_with_relu(h2, name='G_u128')
         print('h2 shape', h2.shape)
 
         h3 = ConvolutionTranspose2D((gkernel,gkernel),
@@ -132,7 +151,8 @@ def convolutional_generator(z):
                                     strides=(gstride, gstride),
                                     pad=True,
                                     output_shape=(IMG_H, IMG_W),
-                                    activation=C.sigmoid)(h2)
+                                    activation=C.sigmoid,
+                                    name='G_u3/conv')(h2)
         print('h3 (output) shape :', h3.shape)
 
         # return C.reshape(h3, img_h * img_w)
@@ -147,19 +167,19 @@ def convolutional_discriminator(x):
         print('Discriminator convolution input shape', x.shape)
         #  x = C.reshape(x, (1, img_h, img_w))
 
-        h0 = Convolution2D((dkernel, dkernel), 1, strides=(dstride, dstride))(x)
-        h0 = bn_with_leaky_relu(h0, leak=0.2)
+        h0 = Convolution2D((dkernel, dkernel), 1, strides=(dstride, dstride), name='D_c1/conv')(x)
+        h0 = bn_with_leaky_relu(h0, leak=0.2, name='D_c1')
         print('h0 shape :', h0.shape)
 
-        h1 = Convolution2D((dkernel, dkernel), df_dim, strides=(dstride, dstride))(h0)
-        h1 = bn_with_leaky_relu(h1, leak=0.2)
+        h1 = Convolution2D((dkernel, dkernel), df_dim, strides=(dstride, dstride), name='D_c64/conv')(h0)
+        h1 = bn_with_leaky_relu(h1, leak=0.2, name='D_c64')
         print('h1 shape :', h1.shape)
 
-        h2 = Dense(dfc_dim, activation=None)(h1)
-        h2 = bn_with_leaky_relu(h2, leak=0.2)
+        h2 = Dense(dfc_dim, activation=None, name='D_fc1024/dense')(h1)
+        h2 = bn_with_leaky_relu(h2, leak=0.2, name='D_fc1024')
         print('h2 shape :', h2.shape)
 
-        h3 = Dense(1, activation=C.sigmoid)(h2)
+        h3 = Dense(1, activation=C.sigmoid, name='D_out/dense')(h2)
         print('h3(output) shape :', h3.shape)
 
         return h3
@@ -228,33 +248,42 @@ def save_trained_models(objects, object_labels, ckp_label, model_dir):
         objects[i].save(checkpoint_file)
 
 
-def train(reader_train, generator, discriminator):
+def train(reader_train, generator, discriminator, profile_start=None, profile_steps=20,
+          num_minibatches=NUM_MINIBATCHES, noise=None):
     X_real, X_fake, Z, G_trainer, D_trainer, tb_G, tb_D = \
     build_graph(G_INPUT_DIM, IMAGE_DIMS, generator,discriminator)
+    noise = noise or NoiseSampler()
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    profiler = None
+    if profile_start is not None:
+        profiler = profiling.StepProfiler({'G': G_trainer.loss_function, 'D': D_trainer.loss_function},
+                                          profile_start, profile_steps)
 
     k = 2
 
-    input_map = {X_real: reader_train.streams.features}
-    for train_step in range(NUM_MINIBATCHES):
+    for train_step in range(num_minibatches):
+        if profiler is not None:
+            profiler.before_step(train_step)
 
         # train the discriminator model for k steps
         for gen_train_step in range(k):
-            Z_data = noise_sample(MINIBATCH_SIZE)
-            X_data = reader_train.next_minibatch(MINIBATCH_SIZE, input_map)
-            if X_data[X_real].num_samples == Z_data.shape[0]:
-                batch_inputs = {X_real: X_data[X_real].data, Z: Z_data}
+            Z_data = noise.sample(MINIBATCH_SIZE)
+            X_data = next_images(reader_train, X_real, MINIBATCH_SIZE)
+            if X_data is not None:
+                batch_inputs = {X_real: X_data, Z: Z_data}
                 D_trainer.train_minibatch(batch_inputs)
 
         # train the generator model for a single step
-        Z_data = noise_sample(MINIBATCH_SIZE)
+        Z_data = noise.sample(MINIBATCH_SIZE)
         batch_inputs = {Z: Z_data}
 
         G_trainer.train_minibatch(batch_inputs)
         G_trainer.train_minibatch(batch_inputs)
 
         if np.mod(train_step, PROGRESS_SAVE_STEP) == 0:
-            noise = noise_sample(36)
-            images = X_fake.eval(noise)
+            images = X_fake.eval(noise.sample(36))
             utils.plot_images(images, subplot_shape=[6, 6],iteration=train_step)
             #checkpoint_file = os.path.join(model_dir, "Generator_{}.dnn".format(train_step))
             #G_trainer.save_checkpoint(checkpoint_file)
@@ -265,10 +294,14 @@ def train(reader_train, generator, discriminator):
         D_trainer.summarize_training_progress()
         G_trainer.summarize_training_progress()
 
-        utils.logTensorBoard(G_trainer, tb_G, "G", train_step)
-        utils.logTensorBoard(D_trainer, tb_D, "D", train_step)
+        utils.logTensorBoard(G_trainer, tb_G, "G", train_step, LOG_PARAMS_STEP)
+        utils.logTensorBoard(D_trainer, tb_D, "D", train_step, LOG_PARAMS_STEP)
 
         G_trainer_loss = G_trainer.previous_minibatch_loss_average
+        if profiler is not None:
+            profiler.after_step(train_step)
+    if profiler is not None:
+        profiler.stop()
     #checkpoint_file = os.path.join(model_dir, "Generator_Final.dnn")        
     #G_trainer.save_checkpoint(checkpoint_file)
     #checkpoint_file = os.path.join(model_dir, "Discriminator_Final.dnn")
@@ -278,14 +311,34 @@ def train(reader_train, generator, discriminator):
     return Z, X_fake, G_trainer_loss
 
 
-reader_train = create_mb_source(MAP_FILE, num_classes=10)
-
-G_input, G_output, G_trainer_loss = train(reader_train,
-                                          convolutional_generator,
-                                          convolutional_discriminator)
-
-print("Training loss of the generator is: {0:.2f}".format(G_trainer_loss))
-
-noise = noise_sample(36)
-images = G_output.eval({G_input: noise})
-utils.plot_images(images, subplot_shape=[6, 6], iteration="test")
+def main():
+    parser = argparse.ArgumentParser(description="Train a DCGAN on MNIST images")
+    parser.add_argument('--cpu', action='store_true', help="train on the CPU instead of GPU 0")
+    parser.add_argument('--minibatches', type=int, default=NUM_MINIBATCHES, help="number of training iterations")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile a window of iterations with CNTK's profiler, reports go to %s" % profiling.PROFILE_DIR)
+    parser.add_argument('--profile-start', type=int, default=10, help="first profiled iteration")
+    parser.add_argument('--profile-steps', type=int, default=20, help="number of profiled iterations")
+    args = parser.parse_args()
+
+    if not os.path.isfile(MAP_FILE) and not imageCache.cache_exists(IMAGE_CACHE):
+        raise ValueError("Can not find map file {0}".format(MAP_FILE))
+    C.device.try_set_default_device(C.device.cpu() if args.cpu else C.device.gpu(0))
+    reader_train = create_reader(MAP_FILE, IMAGE_CACHE, num_classes=10)
+
+    noise = NoiseSampler()
+    G_input, G_output, G_trainer_loss = train(reader_train,
+                                              convolutional_generator,
+                                              convolutional_discriminator,
+                                              profile_start=args.profile_start if args.profile else None,
+                                              profile_steps=args.profile_steps,
+                                              num_minibatches=args.minibatches,
+                                              noise=noise)
+
+    print("Training loss of the generator is: {0:.2f}".format(G_trainer_loss))
+
+    images = G_output.eval({G_input: noise.sample(36)})
+    utils.plot_images(images, subplot_shape=[6, 6], iteration="test")
+
+if __name__ == '__main__':
+    main()
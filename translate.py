@@ -0,0 +1,258 @@
+import argparse
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import cntk as C
+
+import dataUtils
+import imageCache
+import utils
+
+BATCH_SIZE = 8
+NUM_WORKERS = 4
+TILE_OVERLAP = 32
+IN_FLIGHT_BATCHES = 4  # decoded and encoding batches of a frame sequence, each way
+FPS_WINDOW = 100
+
+# A saved G_G_<step>.dnn / G_F_<step>.dnn takes raw 0..255 BGR images and returns 0..1 BGR images
+def load_generator(model_file):
+    model = C.load_model(model_file)
+    print("Loaded %s, input shape %s" % (model_file, model.arguments[0].shape))
+    return model
+
+def generate(model, images):
+    output = np.asarray(model.eval({model.arguments[0]: images}))
+    return output.reshape((-1,) + output.shape[-3:])
+
+# images of a map file, or of a flat folder
+def list_images(source):
+    if os.path.isfile(source):
+        return imageCache.read_map_file(source)
+    return [os.path.join(source, name) for name in sorted(dataUtils.scan_image_folder(source))]
+
+def output_path(output_dir, image_path):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(image_path))[0] + ".png")
+
+def encode_image(rgb, path):
+    Image.fromarray(rgb).save(path)
+
+def timing_report(num_images, seconds):
+    return {'images': num_images, 'seconds': seconds, 'images_per_sec': num_images / seconds if seconds else 0.0,
+            'peak_rss_mb': utils.peak_rss_mb()}
+
+# Decode -> generate -> encode pipeline of folder and sequence translation: images are decoded in order on
+# the pool up to in_flight batches ahead of the forward pass, translated batch_size at a time, and encoded
+# on the pool with at most in_flight batches pending, completed in order. Memory stays bounded by
+# 2 * in_flight batches whatever the number of images. encode(rgb, path) writes one image, progress(done)
+# is called with the number of written images after every batch.
+def run_pipeline(model, paths, output_dir, encode, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS,
+                 in_flight=IN_FLIGHT_BATCHES, progress=None):
+    if in_flight < 1:
+        raise ValueError("in_flight must be at least 1, got {0}".format(in_flight))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    height, width = model.arguments[0].shape[-2:]
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    done = 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        decoded = deque()
+        encoding = deque()
+
+        def submit_decode(batch_index):
+            if batch_index < len(batches):
+                decoded.append([pool.submit(imageCache.decode_image, path, height, width)
+                                for path in batches[batch_index]])
+
+        def finish_encode():
+            nonlocal done
+            for future in encoding.popleft():
+                future.result()
+                done += 1
+            if progress is not None:
+                progress(done)
+
+        for batch_index in range(min(in_flight, len(batches))):
+            submit_decode(batch_index)
+        for batch_index, batch_paths in enumerate(batches):
+            images = np.stack([future.result() for future in decoded.popleft()]).astype(np.float32)
+            submit_decode(batch_index + in_flight)
+
+            rgb = utils.to_rgb_uint8(generate(model, images))
+            while len(encoding) >= in_flight:
+                finish_encode()
+            encoding.append([pool.submit(encode, rgb[i], output_path(output_dir, path))
+                             for i, path in enumerate(batch_paths)])
+        while encoding:
+            finish_encode()
+    return timing_report(len(paths), time.perf_counter() - start)
+
+# Translates every image of paths into output_dir, two batches decoded ahead and two encoding
+def translate_images(model, paths, output_dir, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, in_flight=2):
+    return run_pipeline(model, paths, output_dir, encode_image, batch_size, num_workers, in_flight,
+                        lambda done: print("Translated %d out of %d images" % (done, len(paths))))
+
+# full resolution image as CHW BGR uint8, the layout the generator was trained on
+def decode_full_image(path):
+    img = Image.open(path).convert('RGB')
+    return np.asarray(img, dtype=np.uint8)[..., ::-1].transpose(2, 0, 1)
+
+# start offsets of overlapping tiles covering length, the last tile is aligned with the end
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile]
+
+# blending weight of a tile pixel: ramps up over the overlap from each border, flat in the middle
+def tile_window(tile_h, tile_w, overlap):
+    def ramp(n):
+        r = np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)).astype(np.float32)
+        return np.minimum(r, max(overlap, 1))
+    return np.outer(ramp(tile_h), ramp(tile_w))
+
+# Translates an image of any size by running the generator on overlapping tiles of its input size,
+# tile_batch_size tiles per forward pass, and blending the seams with tile_window.
+# Network memory is bounded by the tile batch; only the output canvas grows with the image.
+def translate_tiled(model, image, overlap=TILE_OVERLAP, tile_batch_size=BATCH_SIZE):
+    tile_h, tile_w = model.arguments[0].shape[-2:]
+    if not 0 <= overlap < min(tile_h, tile_w):
+        raise ValueError("Tile overlap {0} is outside 0..{1}".format(overlap, min(tile_h, tile_w) - 1))
+    _, height, width = image.shape
+    pad_h, pad_w = max(tile_h - height, 0), max(tile_w - width, 0)
+    if pad_h or pad_w:
+        image = np.pad(image, ((0, 0), (0, pad_h), (0, pad_w)), mode='reflect')
+    padded_h, padded_w = image.shape[1:]
+
+    window = tile_window(tile_h, tile_w, overlap)
+    canvas = np.zeros((3, padded_h, padded_w), dtype=np.float32)
+    weights = np.zeros((padded_h, padded_w), dtype=np.float32)
+    positions = [(y, x) for y in tile_starts(padded_h, tile_h, overlap) for x in tile_starts(padded_w, tile_w, overlap)]
+    for i in range(0, len(positions), tile_batch_size):
+        batch_positions = positions[i:i + tile_batch_size]
+        tiles = np.stack([image[:, y:y + tile_h, x:x + tile_w] for y, x in batch_positions]).astype(np.float32)
+        for (y, x), output in zip(batch_positions, generate(model, tiles)):
+            canvas[:, y:y + tile_h, x:x + tile_w] += output * window
+            weights[y:y + tile_h, x:x + tile_w] += window
+
+    canvas /= weights
+    return utils.to_rgb_uint8(canvas[:, :height, :width])[0]
+
+# Tiled translation of full resolution images, one image at a time: the next image is decoded and the
+# previous one encoded on the pool while the current one runs through the generator
+def translate_images_tiled(model, paths, output_dir, overlap=TILE_OVERLAP, tile_batch_size=BATCH_SIZE,
+                           num_workers=NUM_WORKERS):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        next_image = pool.submit(decode_full_image, paths[0]) if paths else None
+        encoding = None
+        for i, path in enumerate(paths):
+            image = next_image.result()
+            next_image = pool.submit(decode_full_image, paths[i + 1]) if i + 1 < len(paths) else None
+            rgb = translate_tiled(model, image, overlap, tile_batch_size)
+            if encoding is not None:
+                encoding.result()
+            encoding = pool.submit(encode_image, rgb, output_path(output_dir, path))
+            print("Translated %d out of %d images" % (i + 1, len(paths)))
+        if encoding is not None:
+            encoding.result()
+    return timing_report(len(paths), time.perf_counter() - start)
+
+# frames of a numbered frame folder in frame order: frame_9.png before frame_10.png
+def list_frames(folder):
+    def frame_key(name):
+        numbers = re.findall(r'[0-9]+', name)
+        return (int(numbers[-1]) if numbers else -1, name)
+    return [os.path.join(folder, name) for name in sorted(dataUtils.scan_image_folder(folder), key=frame_key)]
+
+# index of the first frame without output; frames are written through a temporary file, so every
+# output that exists is complete
+def first_missing_frame(frames, output_dir):
+    for i, path in enumerate(frames):
+        if not os.path.exists(output_path(output_dir, path)):
+            return i
+    return len(frames)
+
+def encode_frame(rgb, path):
+    temp_path = path + ".tmp"
+    Image.fromarray(rgb).save(temp_path, format='PNG')
+    os.replace(temp_path, path)
+
+# Streams a frame sequence through run_pipeline, frames written through temporary files so that
+# first_missing_frame can resume it. Prints sustained frames/sec about every FPS_WINDOW frames.
+def translate_sequence(model, frames, output_dir, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS,
+                       in_flight=IN_FLIGHT_BATCHES, start_frame=0):
+    start = time.perf_counter()
+    window = {'start': start, 'done': 0}
+
+    def progress(done):
+        if done - window['done'] >= FPS_WINDOW or (done > window['done'] and start_frame + done == len(frames)):
+            now = time.perf_counter()
+            print("Frame %d out of %d: %.2f frames/sec over the last %d, %.2f overall" %
+                  (start_frame + done, len(frames), (done - window['done']) / (now - window['start']),
+                   done - window['done'], done / (now - start)))
+            window['start'], window['done'] = now, done
+
+    return run_pipeline(model, frames[start_frame:], output_dir, encode_frame, batch_size, num_workers,
+                        in_flight, progress)
+
+def print_report(report):
+    peak = report['peak_rss_mb']
+    print("%d images in %.1f s: %.2f images/sec, peak memory %s" %
+          (report['images'], report['seconds'], report['images_per_sec'],
+           "%.0f MB" % peak if peak is not None else "n/a"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate a folder or map file of images with a trained generator")
+    parser.add_argument('model', help="G_G_<step>.dnn or G_F_<step>.dnn")
+    parser.add_argument('source', help="image folder or map file")
+    parser.add_argument('output_dir')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help="decode/encode threads")
+    parser.add_argument('--gpu', action='store_true', help="run the generator on GPU 0")
+    parser.add_argument('--tile', action='store_true',
+                        help="translate at full resolution with overlapping tiles instead of resizing")
+    parser.add_argument('--overlap', type=int, default=TILE_OVERLAP, help="tile overlap in pixels")
+    parser.add_argument('--sequence', action='store_true',
+                        help="source is a numbered frame folder, translated as a stream in frame order")
+    parser.add_argument('--in-flight', type=int, default=IN_FLIGHT_BATCHES,
+                        help="batches decoded ahead and pending encode in --sequence mode")
+    parser.add_argument('--start-frame', type=int, default=0, help="first frame to translate in --sequence mode")
+    parser.add_argument('--resume', action='store_true',
+                        help="--sequence mode: continue after the last frame already in output_dir")
+    args = parser.parse_args()
+    if args.in_flight < 1:
+        parser.error("--in-flight must be at least 1")
+
+    C.device.try_set_default_device(C.device.gpu(0) if args.gpu else C.device.cpu())
+    model = load_generator(args.model)
+    tile_size = min(model.arguments[0].shape[-2:])
+    if args.tile and not 0 <= args.overlap < tile_size:
+        parser.error("--overlap must be at least 0 and less than the %d px tile size" % tile_size)
+    if args.sequence:
+        frames = list_frames(args.source)
+        start_frame = first_missing_frame(frames, args.output_dir) if args.resume else args.start_frame
+        if start_frame:
+            print("Starting at frame %d of %d" % (start_frame, len(frames)))
+        report = translate_sequence(model, frames, args.output_dir, args.batch_size, args.workers,
+                                    args.in_flight, start_frame)
+    elif args.tile:
+        report = translate_images_tiled(model, list_images(args.source), args.output_dir,
+                                        args.overlap, args.batch_size, args.workers)
+    else:
+        report = translate_images(model, list_images(args.source), args.output_dir,
+                                  args.batch_size, args.workers)
+    print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import numpy as np
+from PIL import Image
+
+import cntk as C
+
+import imageCache
+import translate
+import utils
+
+HOST = "127.0.0.1"
+PORT = 8080
+MAX_BATCH_SIZE = 8
+MAX_DELAY_MS = 20  # longest a request waits for others to share its batch
+MAX_QUEUE = 256
+METRICS_WINDOW = 1000  # requests the latency percentiles are computed over
+
+# Gathers images submitted from many threads into batches for one inference thread.
+# A batch starts with the oldest waiting request and closes when it holds max_batch_size images or
+# max_delay_ms after that request arrived, whichever comes first; under load, requests that queued up
+# during the previous batch fill the next one right away.
+class DynamicBatcher(object):
+    def __init__(self, generate, max_batch_size=MAX_BATCH_SIZE, max_delay_ms=MAX_DELAY_MS, max_queue=MAX_QUEUE):
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self.requests = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=METRICS_WINDOW)
+        self.batch_sizes = {}
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_failed_batches = 0
+        self.num_failed = 0
+        self.inference_time = 0.0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self.thread.start()
+
+    # future of the translated 0..1 BGR image; raises queue.Full when the server is overloaded
+    def submit(self, image):
+        future = Future()
+        try:
+            self.requests.put_nowait((time.perf_counter(), image, future))
+        except queue.Full:
+            with self.lock:
+                self.num_rejected += 1
+            raise
+        return future
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_delay
+        while len(batch) < self.max_batch_size:
+            # requests that are already waiting always join, the deadline only limits waiting for new ones
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.closed = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self.closed:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            try:
+                outputs = self.generate(np.stack([image for _, image, _ in batch]).astype(np.float32))
+            except Exception as e:
+                with self.lock:
+                    self.num_failed_batches += 1
+                    self.num_failed += len(batch)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self.lock:
+                self.inference_time += done - start
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                self.num_requests += len(batch)
+                self.latencies.extend(done - arrival for arrival, _, _ in batch)
+            for (_, _, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            num_batches = sum(self.batch_sizes.values())
+            return {'queue_depth': self.requests.qsize(),
+                    'requests': self.num_requests,
+                    'rejected': self.num_rejected,
+                    'failed': self.num_failed,
+                    'failed_batches': self.num_failed_batches,
+                    'batches': num_batches,
+                    'mean_batch_size': self.num_requests / float(num_batches) if num_batches else 0.0,
+                    'batch_sizes': dict((str(size), count) for size, count in sorted(self.batch_sizes.items())),
+                    'inference_ms_per_batch': self.inference_time * 1000 / num_batches if num_batches else 0.0,
+                    'latency_ms': dict(('p%d' % p, float(np.percentile(latencies, p)) if len(latencies) else 0.0)
+                                       for p in (50, 95, 99))}
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+def encode_response(image):
+    output = io.BytesIO()
+    Image.fromarray(utils.to_rgb_uint8(image)[0]).save(output, format='PNG')
+    return output.getvalue()
+
+# POST /translate with an image body returns the translated PNG; GET /metrics returns the batcher metrics.
+# Decoding and encoding run on the request's own handler thread, only the forward pass on the batcher.
+class TranslationHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/translate':
+            self.send_error(404)
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = imageCache.decode_image(io.BytesIO(data), *self.server.image_shape[-2:])
+        except Exception:
+            self.send_error(400, "body is not an image")
+            return
+        try:
+            future = self.server.batcher.submit(image)
+        except queue.Full:
+            self.send_error(503, "too many pending requests")
+            return
+        try:
+            output = future.result()
+        except Exception as e:
+            self.send_error(500, "translation failed", str(e))
+            return
+        self._send(200, 'image/png', encode_response(output))
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send(200, 'application/json', json.dumps(self.server.batcher.metrics(), indent=2).encode())
+        elif self.path == '/health':
+            self._send(200, 'text/plain', b"ok")
+        else:
+            self.send_error(404)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def create_server(model, host=HOST, port=PORT, max_batch_size=MAX_BATCH_SIZE, max_delay_ms=MAX_DELAY_MS):
+    server = ThreadingHTTPServer((host, port), TranslationHandler)
+    server.daemon_threads = True
+    server.image_shape = model.arguments[0].shape
+    server.batcher = DynamicBatcher(lambda images: translate.generate(model, images), max_batch_size, max_delay_ms)
+    return server
+
+# Load generator for trying the server out on localhost: num_requests POSTs of image_file from
+# concurrency threads, then the client side latency and the server's metrics
+def run_client(url, image_file, num_requests=100, concurrency=8):
+    with open(image_file, 'rb') as f:
+        data = f.read()
+
+    def post(_):
+        start = time.perf_counter()
+        request = Request(url + '/translate', data=data, headers={'Content-Type': 'application/octet-stream'})
+        with urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(post, range(num_requests)))) * 1000
+    elapsed = time.perf_counter() - start
+    print("%d requests from %d threads in %.1f s: %.2f images/sec, latency p50 %.0f ms, p95 %.0f ms" %
+          (num_requests, concurrency, elapsed, num_requests / elapsed,
+           np.percentile(latencies, 50), np.percentile(latencies, 95)))
+    with urlopen(url + '/metrics') as response:
+        print(response.read().decode())
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a trained generator over HTTP with dynamic batching")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('model', help="G_G_<step>.dnn or G_F_<step>.dnn")
+    serve_parser.add_argument('--host', default=HOST)
+    serve_parser.add_argument('--port', type=int, default=PORT)
+    serve_parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    serve_parser.add_argument('--max-delay-ms', type=float, default=MAX_DELAY_MS,
+                              help="latency budget for gathering a batch")
+    serve_parser.add_argument('--gpu', action='store_true', help="run the generator on GPU 0")
+    client_parser = subparsers.add_parser('client', help="send concurrent requests to a running server")
+    client_parser.add_argument('image')
+    client_parser.add_argument('--url', default="http://%s:%d" % (HOST, PORT))
+    client_parser.add_argument('--requests', type=int, default=100)
+    client_parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        C.device.try_set_default_device(C.device.gpu(0) if args.gpu else C.device.cpu())
+        server = create_server(translate.load_generator(args.model), args.host, args.port,
+                               args.max_batch_size, args.max_delay_ms)
+        print("Serving %s on http://%s:%d (POST /translate, GET /metrics)" % (args.model, args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        server.batcher.close()
+    elif args.command == 'client':
+        run_client(args.url, args.image, args.requests, args.concurrency)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
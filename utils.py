@@ -1,36 +1,82 @@
-import matplotlib.pyplot as plt
 import os
+import sys
 import numpy as np
-from cntk import reduce_mean
-import os
-from scipy.misc import imsave
-
-def plot_images(images, subplot_shape, iteration):
-    dirToSave = "testResults/"
-    if not os.path.exists(dirToSave):
-        os.makedirs(dirToSave)
-    filePathName = dirToSave + "test_"
-    path = ''.join([filePathName, "_", str(iteration).zfill(4), '.png'])
-    path_txt = ''.join([filePathName, "_", str(iteration).zfill(4), '.txt'])
-    plt.style.use('ggplot')
-    fig, axes = plt.subplots(*subplot_shape)
-    indx = 0
-    for image, ax in zip(images, axes.flatten()):
-        reshaped = None
-        if image.shape[0] == 3:
-            reshaped = np.rollaxis(image, 0,3)
-        else:
-            reshaped = image.reshape(28, 28)
-        ax.imshow(reshaped, vmin=0, vmax=1.0, cmap='gray')
-        ax.axis('off')
-        indx = indx + 1
-    plt.savefig(path, dpi = 100)
-
-def logTensorBoard(trainer, tbWriter, prefix, trainStep):
-    # Log mean of each parameter tensor, so that we can confirm that the parameters change indeed.
-    for parameter in trainer.model.parameters:
-        tbWriter.write_value("{0}_{1}_{2}{3}".format(prefix, parameter.name, parameter.uid, "/mean"),
-                             reduce_mean(parameter).eval(), trainStep)
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+PLOT_DIR = "testResults/"
+PLOT_SCALE = 4  # grid pixels per image pixel, 28x28 samples are hard to see otherwise
+
+def plot_path(iteration):
+    return ''.join([PLOT_DIR, "test_", "_", str(iteration).zfill(4), '.png'])
+
+# Samples as HWC (or HW for grayscale) uint8: 3 channel images are CHW, anything else is a flat 28x28
+# image, values 0..1 as the generators output them
+def plot_arrays(images):
+    images = np.asarray(images)
+    if images.ndim == 4 and images.shape[1] == 3:
+        images = images.transpose(0, 2, 3, 1)
+    else:
+        images = images.reshape(-1, 28, 28)
+    return (np.clip(images, 0, 1.0) * 255).astype(np.uint8)
+
+# Writes the first rows x columns samples of images as one grid image to testResults/.
+# The grid is composed with numpy and saved with PIL, so nothing is kept alive between calls;
+# backend='matplotlib' draws the previous subplot figure instead.
+def plot_images(images, subplot_shape, iteration, backend='numpy', scale=PLOT_SCALE):
+    if not os.path.exists(PLOT_DIR):
+        os.makedirs(PLOT_DIR)
+    path = plot_path(iteration)
+    num_rows, num_columns = subplot_shape
+    samples = plot_arrays(images)[:num_rows * num_columns]
+    if backend == 'matplotlib':
+        plot_images_matplotlib(samples, subplot_shape, path)
+        return path
+
+    grid = tile_images(samples, num_columns=num_columns, padding=1)
+    if scale > 1:
+        grid = grid.repeat(scale, axis=0).repeat(scale, axis=1)
+    Image.fromarray(grid).save(path)
+    return path
+
+# Draws on its own Agg canvas instead of through pyplot, so the caller's backend and style are left alone
+def plot_images_matplotlib(samples, subplot_shape, path):
+    import matplotlib.style
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    with matplotlib.style.context('ggplot'):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(*subplot_shape, squeeze=False)
+        for image, ax in zip(samples, axes.flatten()):
+            ax.imshow(image, vmin=0, vmax=255, cmap='gray')
+            ax.axis('off')
+        fig.savefig(path, dpi=100)
+
+# mean, std, L2 norm and max of every array in values, from a single concatenated pass
+def parameter_stats(values):
+    sizes = np.array([value.size for value in values])
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    flat = np.concatenate([value.ravel() for value in values]).astype(np.float64)
+    sums = np.add.reduceat(flat, offsets)
+    squares = np.add.reduceat(flat * flat, offsets)
+    mean = sums / sizes
+    std = np.sqrt(np.maximum(squares / sizes - mean * mean, 0))
+    return mean, std, np.sqrt(squares), np.maximum.reduceat(flat, offsets)
+
+def logTensorBoard(trainer, tbWriter, prefix, trainStep, stride=1):
+    # Log statistics of each parameter tensor, so that we can confirm that the parameters change indeed.
+    # Each parameter value is read once and reduced with NumPy, only every `stride` steps.
+    if trainStep % stride != 0:
+        return
+    parameters = trainer.model.parameters
+    stats = parameter_stats([parameter.value for parameter in parameters])
+    for i, parameter in enumerate(parameters):
+        tag = "{0}_{1}_{2}".format(prefix, parameter.name, parameter.uid)
+        for name, values in zip(("/mean", "/std", "/norm", "/max"), stats):
+            tbWriter.write_value(tag + name, float(values[i]), trainStep)
 
 def save_trained_models(objects, object_labels, ckp_label, model_dir):
     if not os.path.exists(model_dir):
@@ -39,21 +85,78 @@ def save_trained_models(objects, object_labels, ckp_label, model_dir):
     for i in range(len(objects)):
         checkpoint_file = os.path.join(model_dir, \
                                        "{}_{}.dnn".format(object_labels[i], ckp_label))
-        objects[i].save(checkpoint_file)
+        objects[i].save(checkpoint_file + ".tmp")
+        os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+# CHW images in BGR channel order (as read by the CNTK image readers) with values in [0, 1]
+# to HWC RGB uint8: the only channel swap done before encoding
+def to_rgb_uint8(images):
+    images = np.asarray(images)
+    images = images.reshape((-1,) + images.shape[-3:])
+    return np.clip(images * 255, 0, 255).astype(np.uint8)[:, ::-1].transpose(0, 2, 3, 1)
+
+# tile N HWC images into one grid image, num_columns defaults to a square-ish grid
+def tile_images(images, num_columns=None, padding=2, pad_value=255):
+    images = np.asarray(images)
+    n, h, w = images.shape[:3]
+    if num_columns is None:
+        num_columns = int(np.ceil(np.sqrt(n)))
+    num_rows = int(np.ceil(n / float(num_columns)))
+    grid = np.full((num_rows * (h + padding) - padding, num_columns * (w + padding) - padding) + images.shape[3:],
+                   pad_value, dtype=images.dtype)
+    for i in range(n):
+        row, col = divmod(i, num_columns)
+        grid[row * (h + padding):row * (h + padding) + h, col * (w + padding):col * (w + padding) + w] = images[i]
+    return grid
+
+def save_generated_images(images, model_name, train_step, images_dir, contact_sheet=False):
+    rgb = to_rgb_uint8(images)
+    if contact_sheet:
+        if not os.path.exists(images_dir):
+            os.makedirs(images_dir)
+        Image.fromarray(tile_images(rgb)).save(os.path.join(images_dir, "%s_%d.png" % (model_name, train_step)))
+        return
 
-def save_generated_images(images, model_name, train_step, images_dir):
     model_images_dir = os.path.join(images_dir, "%s_%d" % (model_name, train_step))
     if not os.path.exists(model_images_dir):
         os.makedirs(model_images_dir)
+    for i in range(len(rgb)):
+        Image.fromarray(rgb[i]).save(os.path.join(model_images_dir, "%d.png" % i))
+
+# Writes sample images on a background pool so that encoding and disk I/O never stall training.
+# At most max_pending batches wait to be written; when the disk falls behind, new batches are
+# dropped (and counted) instead of blocking the caller.
+class SampleWriter(object):
+    def __init__(self, images_dir, num_workers=2, max_pending=8, contact_sheet=True):
+        self.images_dir = images_dir
+        self.contact_sheet = contact_sheet
+        self.dropped = 0
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def submit(self, images, model_name, train_step):
+        if not self._pending.acquire(blocking=False):
+            self.dropped += 1
+            return False
+        future = self._pool.submit(save_generated_images, np.array(images), model_name, train_step,
+                                   self.images_dir, self.contact_sheet)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        self._pending.release()
+        if future.exception() is not None:
+            print("Failed to write sample images: %s" % future.exception())
+
+    def close(self):
+        self._pool.shutdown(wait=True)
 
-    for i in range(len(images)):
-        # img = images[i].transpose(1,2,0)
-        img = images[i].transpose(2, 1, 0)
-        img = img * 255
-        img_file_path = os.path.join(model_images_dir, "%d.png" % i)
-        imsave(img_file_path, img)
-
-        rgb = img
-        bgr = rgb[..., ::-1]
-        img_file_path = os.path.join(model_images_dir, "%d_bgr.png" % i)
-        imsave(img_file_path, bgr)
+# peak resident set size of this process in MB, None where the platform does not report it
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
@@ -0,0 +1,25 @@
+import json
+import subprocess
+import sys
+
+# Benchmarks that need a process of their own (peak RSS of one configuration, out-of-memory probes,
+# mpiexec workers) run a worker command that prints its result as one JSON line after RESULT_MARKER.
+RESULT_MARKER = "RESULT "
+
+class WorkerError(RuntimeError):
+    pass
+
+# Called by the worker process
+def print_result(result):
+    print(RESULT_MARKER + json.dumps(result))
+    sys.stdout.flush()
+
+# Runs a worker command and returns the last result it printed; raises WorkerError with the last line of
+# its error output when it fails or prints no result
+def run_worker(command):
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    lines = [line for line in process.stdout.decode().splitlines() if line.startswith(RESULT_MARKER)]
+    if process.returncode != 0 or not lines:
+        error = process.stderr.decode().strip().splitlines()
+        raise WorkerError(error[-1] if error else "exit code %d" % process.returncode)
+    return json.loads(lines[-1][len(RESULT_MARKER):])